@@ -1,6 +1,8 @@
+import io
 from pathlib import Path
 from typing import Any, Dict, List
 import zipfile
+import zlib
 import argparse
 
 from boltons.cacheutils import cachedproperty
@@ -21,37 +23,118 @@ import metadata.b_iam as metadata
 
 ZIP_FILENAME = metadata.ZIP_FILENAME
 EXTRACTED_DATASET_DIRNAME = metadata.EXTRACTED_DATASET_DIRNAME
+INDEX_FILENAME = metadata.INDEX_FILENAME
+SPLIT_FILENAMES = {"train": "train_ids", "val": "val_ids", "test": "test_ids"}
 ###LINE_PADDING = metadata.LINE_REGION_PADDING
 
 class BIAM(BaseDataModule):
+    """B_IAM forms and their line labels.
+
+    If the zip file is present, files are read on demand straight from it, using an in-memory index of its
+    members, unless extract_data is set, in which case prepare_data extracts it and files are read from disk.
+    Without a zip file, the already extracted dataset is used.
+    """
+
     def __init__(self,args: argparse.Namespace = None):
         super().__init__(args)
-    
+        self.extract_data = self.args.get("extract_data", "false").lower() == "true"
+        self._zip_file = None  # opened lazily in each process
+
     def prepare_data(self):
+        """Extract the members of the zip file that are missing or changed, and remove those no longer in it.
+
+        Only done if extract_data is set. Extracted members are recorded with their CRC-32 in a manifest,
+        so that unchanged members are skipped without reading them.
+        """
+        if not Path(ZIP_FILENAME).exists() or not self.extract_data:
+            return
         extracted_data_dir = Path(EXTRACTED_DATASET_DIRNAME)
-        json_files_exist = len(list((Path(EXTRACTED_DATASET_DIRNAME) / "json").glob("*.json"))) > 0
-        if not extracted_data_dir.exists() or not json_files_exist:
-            # Create necessary directories before extraction
-            os.makedirs(extracted_data_dir, exist_ok=True)
-            with zipfile.ZipFile(ZIP_FILENAME, "r") as zip_file:
-                zip_file.extractall(extracted_data_dir)
-                
+        os.makedirs(extracted_data_dir, exist_ok=True)
+        manifest = {}
+        if _extraction_manifest_filename().exists():
+            with open(_extraction_manifest_filename(), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+
+        with zipfile.ZipFile(ZIP_FILENAME, "r") as zip_file:
+            crcs = {info.filename: info.CRC for info in zip_file.infolist() if not info.is_dir()}
+            for name, crc in crcs.items():
+                if manifest.get(name) != crc or not (extracted_data_dir / name).exists():
+                    if _file_crc(extracted_data_dir / name) != crc:
+                        zip_file.extract(name, extracted_data_dir)
+        for name in set(manifest) - set(crcs):
+            (extracted_data_dir / name).unlink(missing_ok=True)
+
+        with open(_extraction_manifest_filename(), "w", encoding="utf-8") as f:
+            json.dump(crcs, f, indent=4, ensure_ascii=False)
+        self.__dict__.pop("index", None)  # files may have changed since the index was built
+
     def setup(self):
         self.prepare_data()            
                 
     def load_image(self, id):
-        image_path = Path(EXTRACTED_DATASET_DIRNAME) / "forms" / f"{id}.jpg"
-        image = util.read_image_pil(image_uri=image_path,grayscale=True)
+        image = util.read_image_pil_file(io.BytesIO(self.read_file(f"forms/{id}.jpg")), grayscale=True)
         image = ImageOps.invert(image)
         return image
     
+    def form_hash(self, id):
+        """Return a checksum of the image and label files of a form, which changes whenever either of them does."""
+        return self.index["forms"][id]["hash"]
+
+    @property
+    def read_from_zip(self) -> bool:
+        """Whether dataset files are read directly from the zip file instead of from the extracted dataset."""
+        return Path(ZIP_FILENAME).exists() and not self.extract_data
+
+    def read_file(self, name: str) -> bytes:
+        """Read a dataset file by its path relative to the dataset root, e.g. "forms/<id>.jpg"."""
+        if self.read_from_zip:
+            if self._zip_file is None:
+                self._zip_file = zipfile.ZipFile(ZIP_FILENAME, "r")
+            return self._zip_file.read(self._zip_index[name])
+        with open(Path(EXTRACTED_DATASET_DIRNAME) / name, "rb") as f:
+            return f.read()
+
+    def _file_stamps(self) -> Dict[str, str]:
+        """A dictionary mapping the paths of all dataset files, relative to the dataset root, to a version stamp.
+
+        Stamps are CRC-32s for zip members and sizes and modification times for extracted files,
+        so that they change whenever the file does, without reading it.
+        """
+        if self.read_from_zip:
+            return {name: f"{info.CRC:08x}" for name, info in self._zip_index.items()}
+        stamps = {}
+        for dirname in ["forms", "json", "task"]:
+            with os.scandir(Path(EXTRACTED_DATASET_DIRNAME) / dirname) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        stamps[f"{dirname}/{entry.name}"] = f"{stat.st_size}:{stat.st_mtime_ns}"
+        return stamps
+
+    def _file_hash(self, name: str, stamp: str) -> str:
+        """Return a checksum of a dataset file with the given version stamp."""
+        if self.read_from_zip:
+            return stamp  # CRC-32 from the central directory
+        return util.compute_sha256(Path(EXTRACTED_DATASET_DIRNAME) / name)
+
+    @cachedproperty
+    def _zip_index(self) -> Dict[str, zipfile.ZipInfo]:
+        """A dictionary mapping member names to their entries in the central directory of the zip file."""
+        with zipfile.ZipFile(ZIP_FILENAME, "r") as zip_file:
+            return {info.filename: info for info in zip_file.infolist() if not info.is_dir()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_zip_file"] = None  # open file handles can not be sent to other processes
+        return state
+
     def __repr__(self):
         """Print info about the dataset."""
         info = ["BIAM Dataset"]
         info.append(f"Total Images: {len(self.json_filenames)}")
         info.append(f"Total Test Images: {len(self.test_ids)}")
         info.append(f"Total Paragraphs: {len(self.paragraph_string_by_id)}")
-        num_lines = sum(len(line_regions) for line_regions in self.line_regions_by_id.values())
+        num_lines = sum(len(line_strings) for line_strings in self.line_strings_by_id.values())
         info.append(f"Total Lines: {num_lines}")
 
         # Return the joined string representation
@@ -61,13 +144,57 @@ class BIAM(BaseDataModule):
     def add_to_argparse(parser):
         BaseDataModule.add_to_argparse(parser)
         parser.add_argument("--augment_data", type=str, default="true")
+        parser.add_argument(
+            "--extract_data",
+            type=str,
+            default="false",
+            help="Whether to extract the zip file to disk, instead of reading files from it on demand.",
+        )
         return parser
     
+    @cachedproperty
+    def index(self) -> Dict[str, Any]:
+        """A table of the forms and splits of the dataset, built in a single pass over its files.
+
+        "splits" maps split names to form IDs, in the order of the split files, and "forms" maps each
+        form ID with a JSON file to its "form" and "json" file paths, "lines" texts, "split" and source "hash".
+        The table is saved to INDEX_FILENAME, and entries of forms whose files are unchanged are reused
+        from there on later builds, so that labels are parsed and files hashed only once across runs.
+        """
+        stamps = self._file_stamps()
+        cached = _load_index()
+        mode = "zip" if self.read_from_zip else "extracted"
+        cached_forms = cached["forms"] if cached.get("mode") == mode else {}
+
+        splits = {split: _read_split_ids(self.read_file(f"task/{name}.txt")) for split, name in SPLIT_FILENAMES.items()}
+        split_by_id = {id_: split for split, ids in splits.items() for id_ in ids}
+
+        forms = {}
+        for json_name in sorted(name for name in stamps if name.startswith("json/") and name.endswith(".json")):
+            id_ = Path(json_name).stem
+            form_name = f"forms/{id_}.jpg"
+            stamp = f"{stamps[json_name]}/{stamps.get(form_name)}"
+            entry = cached_forms.get(id_)
+            if entry is None or entry["stamp"] != stamp:
+                names = [name for name in [form_name, json_name] if name in stamps]
+                entry = {
+                    "form": form_name if form_name in stamps else None,
+                    "json": json_name,
+                    "stamp": stamp,
+                    "hash": "".join(self._file_hash(name, stamps[name]) for name in names),
+                    "lines": _get_line_strings_from_json(self.read_file(json_name)),
+                }
+            forms[id_] = {**entry, "split": split_by_id.get(id_)}
+
+        index = {"mode": mode, "splits": splits, "forms": forms}
+        if index != cached:
+            _save_index(index)
+        return index
+
     @cachedproperty
     def all_ids(self):
         """A list of all form IDs from JSON files."""
-        json_filenames = list((Path(EXTRACTED_DATASET_DIRNAME) / "json").glob("*.json"))
-        return sorted([f.stem for f in json_filenames]) 
+        return sorted(self.index["forms"])
     
     @cachedproperty
     def ids_by_split(self):
@@ -89,22 +216,22 @@ class BIAM(BaseDataModule):
     @cachedproperty
     def train_ids(self):
         """A list of form IDs which are in the training set."""
-        return _read_split_ids("train_ids")
+        return self.index["splits"]["train"]
 
     @cachedproperty
     def test_ids(self):
         """A list of form IDs from the test set."""
-        return _read_split_ids("test_ids")
+        return self.index["splits"]["test"]
 
     @cachedproperty
     def validation_ids(self):
         """A list of form IDs from the validation set."""
-        return _read_split_ids("val_ids")
+        return self.index["splits"]["val"]
     
     @property
     def json_filenames(self):
         """A list of the filenames of all .json files, which contain label information."""
-        return list((Path(EXTRACTED_DATASET_DIRNAME) / "json").glob("*.json"))
+        return [Path(entry["json"]) for entry in self.index["forms"].values()]
 
     @property
     def json_filenames_by_id(self):
@@ -114,18 +241,17 @@ class BIAM(BaseDataModule):
     @property
     def form_filenames(self):
         """A list of the filenames of all .jpg files, which contain images of B_IAM forms."""
-        return list((Path(EXTRACTED_DATASET_DIRNAME) / "forms").glob("*.jpg"))
+        return [Path(entry["form"]) for entry in self.index["forms"].values() if entry["form"] is not None]
     
     @property
     def form_filenames_by_id(self):
         """A dictionary mapping form IDs to their JPEG images."""
-        form_filenames = list((Path(EXTRACTED_DATASET_DIRNAME) / "forms").glob("*.jpg"))
-        return {filename.stem: filename for filename in form_filenames}
+        return {filename.stem: filename for filename in self.form_filenames}
     
     @cachedproperty
     def line_strings_by_id(self):
         """A dict mapping an BIAM form id to its list of line texts."""
-        return {filename.stem: _get_line_strings_from_json_file(filename) for filename in self.json_filenames}
+        return {id_: entry["lines"] for id_, entry in self.index["forms"].items()}
     
     @cachedproperty
     def paragraph_string_by_id(self):
@@ -133,15 +259,43 @@ class BIAM(BaseDataModule):
         return {id_: NEW_LINE_TOKEN.join(line_strings) for id_, line_strings in self.line_strings_by_id.items()}
 
     
-def _read_split_ids(split_name):
-        """Read form IDs for the specified split from the text file."""
-        split_ids_file = Path(EXTRACTED_DATASET_DIRNAME) / "task" / f"{split_name}.txt"
-        with open(split_ids_file, "r") as f:
-            return [line.strip() for line in f]
+def _load_index() -> Dict[str, Any]:
+    """Return the saved index of the dataset, or an empty one if there is none."""
+    try:
+        with open(INDEX_FILENAME, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_index(index: Dict[str, Any]) -> None:
+    """Save the index of the dataset, replacing the previous one atomically, since other processes may read it."""
+    Path(INDEX_FILENAME).parent.mkdir(parents=True, exist_ok=True)
+    temp_filename = Path(f"{INDEX_FILENAME}.{os.getpid()}.tmp")
+    with open(temp_filename, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(temp_filename, INDEX_FILENAME)
+
+def _extraction_manifest_filename() -> Path:
+    """Return filename of the manifest of members extracted from the zip file."""
+    return Path(EXTRACTED_DATASET_DIRNAME) / "_manifest.json"
+
+def _file_crc(filename: Path) -> int:
+    """Return CRC-32 of a file, or None if it does not exist."""
+    if not filename.exists():
+        return None
+    crc = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _read_split_ids(split_ids_data: bytes) -> List[str]:
+        """Read form IDs for a split from the contents of its text file."""
+        return [line.strip() for line in split_ids_data.decode("utf-8").splitlines()]
         
-def _get_line_strings_from_json_file(filename: str) -> List[str]:
+def _get_line_strings_from_json(json_data: bytes) -> List[str]:
     """Get the text content of each line."""
-    json_line_elements = _get_line_elements_from_json_file(filename)
+    json_line_elements = _get_line_elements_from_json(json_data)
     return [_get_text_from_json_element(el) for el in json_line_elements]
 
 def _get_text_from_json_element(line_element: Dict[str, Any]) -> str:
@@ -150,17 +304,14 @@ def _get_text_from_json_element(line_element: Dict[str, Any]) -> str:
         return line_element["label"]
     return ""
 
-def _get_line_elements_from_json_file(filename: str) -> List[Dict[str, Any]]:
-    with open(filename, 'r', encoding='utf-8') as file:
-        json_data = file.read()
-
-        # Parse JSON data
-        parsed_data = json.loads(json_data)
+def _get_line_elements_from_json(json_data: bytes) -> List[Dict[str, Any]]:
+    # Parse JSON data
+    parsed_data = json.loads(json_data.decode("utf-8"))
 
-        # Extract the "line" elements
-        lines = parsed_data["line"] if "line" in parsed_data else []
+    # Extract the "line" elements
+    lines = parsed_data["line"] if "line" in parsed_data else []
 
-        return lines
+    return lines
         
 if __name__ == "__main__":
     load_and_print_info(BIAM)
@@ -1,10 +1,15 @@
 import argparse
+from functools import partial
+import hashlib
 import json
+import multiprocessing
 from pathlib import Path
-from typing import Callable, Dict, Optional, Sequence, Tuple
+import shutil
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 from PIL import Image
+import torch
 
 import os
 import sys
@@ -13,17 +18,41 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
-from data.base_data_module import BaseDataModule, load_and_print_info
+from data.base_data_module import BaseDataModule, DEFAULT_NUM_WORKERS, load_and_print_info
 from data.B_iam import BIAM
-from data.data_util import BaseDataset, convert_strings_to_labels, resize_image
+from data.data_util import (
+    BaseDataset,
+    collate_and_augment,
+    collate_padded_images,
+    collate_trimmed_targets,
+    GraphemeTokenizer,
+    label_lengths,
+    resize_image,
+    ShardedImages,
+    SharedImages,
+    Tokenizer,
+    VariantImages,
+    write_image_shards,
+)
 import metadata.b_iam_paragraphs as metadata
-from stems.paragraph import ParagraphStem
+from stems.image import fit_shape, ImageStem
+from stems.paragraph import ParagraphBatchAugment, ParagraphStem
 
 IMAGE_SCALE_FACTOR = metadata.IMAGE_SCALE_FACTOR
+IMAGE_SHAPE = metadata.IMAGE_SHAPE
 MAX_LABEL_LENGTH = metadata.MAX_LABEL_LENGTH
 NEW_LINE_TOKEN = metadata.NEW_LINE_TOKEN
 PROCESSED_DATA_DIRNAME = metadata.PROCESSED_DATA_DIRNAME
 
+LABEL_MODE = "character"
+AUGMENT_MODE = "pil"
+KEEP_ASPECT_RATIO = "false"
+TRIM_LABELS = "true"
+DATA_STORAGE = "shards"
+AUGMENTED_VARIANTS = 0
+AUGMENTED_VARIANTS_SEED = 0
+TOKENIZERS = {"character": Tokenizer, "grapheme": GraphemeTokenizer}
+
 
 class BIAMParagraphs(BaseDataModule):
     """IAM Handwriting database paragraphs."""
@@ -31,55 +60,192 @@ class BIAMParagraphs(BaseDataModule):
     def __init__(self, args: argparse.Namespace = None):
         super().__init__(args)
         self.augment = self.args.get("augment_data", "true").lower() == "true"
+        self.num_preprocessing_workers = self.args.get("num_preprocessing_workers", DEFAULT_NUM_WORKERS)
 
         self.mapping = metadata.MAPPING
         self.inverse_mapping = {v: k for k, v in enumerate(self.mapping)}
+        self.label_mode = self.args.get("label_mode", LABEL_MODE)
+        self.tokenizer = TOKENIZERS[self.label_mode](self.mapping)
 
         self.input_dims = metadata.DIMS  # We assert that this is correct in setup()
         self.output_dims = metadata.OUTPUT_DIMS  # We assert that this is correct in setup()
 
-        self.transform = ParagraphStem()
-        self.trainval_transform = ParagraphStem(augment=self.augment)
+        self.augment_mode = self.args.get("augment_mode", AUGMENT_MODE)
+        self.keep_aspect_ratio = str(self.args.get("keep_aspect_ratio", KEEP_ASPECT_RATIO)).lower() == "true"
+        if self.keep_aspect_ratio and self.augment_mode != "pil":
+            raise ValueError("Batch augmentation needs images of equal size, so it cannot keep aspect ratios")
+
+        self.transform = ParagraphStem(keep_aspect_ratio=self.keep_aspect_ratio)
+        self.batch_augment, self.collate_augment = None, None
+        if self.augment_mode != "pil":
+            # train images are only resized one by one, and augmented as whole batches, either after transfer to
+            # the device or, with augment_mode 'collate', when collated in the workers, e.g. on CPU-only nodes
+            self.trainval_transform = ParagraphStem()
+            batch_augment = ParagraphBatchAugment() if self.augment else None
+            if self.augment_mode == "batch":
+                self.batch_augment = batch_augment
+            else:
+                self.collate_augment = batch_augment
+        else:
+            self.trainval_transform = ParagraphStem(augment=self.augment, keep_aspect_ratio=self.keep_aspect_ratio)
+        if self.keep_aspect_ratio:
+            # images of a batch are padded to a common size, and their sizes are returned as a third element
+            self.collate_fn = collate_padded_images
+            self.bucket_batches = True
+        self.data_storage = self.args.get("data_storage", DATA_STORAGE)
+        self.augmented_variants = self.args.get("augmented_variants", AUGMENTED_VARIANTS) if self.augment else 0
+        if self.augmented_variants > 0 and self.augment_mode != "pil":
+            raise ValueError("Pre-augmented variants replace batch augmentation, so they cannot be combined")
+        self.trim_labels = str(self.args.get("trim_labels", TRIM_LABELS)).lower() == "true"
+        if self.trim_labels:
+            # labels of a batch are only padded to its longest label, rather than to output_dims
+            self.collate_fn = partial(
+                collate_trimmed_targets, padding_index=self.inverse_mapping["<P>"], collate=self.collate_fn
+            )
     
     @staticmethod
     def add_to_argparse(parser):
-        BaseDataModule.add_to_argparse(parser)
-        parser.add_argument("--augment_data", type=str, default="true")
+        BIAM.add_to_argparse(parser)
+        parser.add_argument(
+            "--num_preprocessing_workers",
+            type=int,
+            default=DEFAULT_NUM_WORKERS,
+            help=f"Number of processes creating crops in prepare_data. Default is {DEFAULT_NUM_WORKERS}.",
+        )
+        parser.add_argument(
+            "--label_mode",
+            type=str,
+            default=LABEL_MODE,
+            choices=list(TOKENIZERS),
+            help="Whether labels have one token per character, or per longest matching grapheme of the mapping.",
+        )
+        parser.add_argument(
+            "--augment_mode",
+            type=str,
+            default=AUGMENT_MODE,
+            choices=["pil", "batch", "collate"],
+            help="Augment train images one by one with PIL in the workers, as tensor batches after transfer to the "
+            "device ('batch', for GPUs), or as tensor batches when collated in the workers ('collate', for CPUs).",
+        )
+        parser.add_argument(
+            "--keep_aspect_ratio",
+            type=str,
+            default=KEEP_ASPECT_RATIO,
+            help="Resize images within the input dims with their own aspect ratio, and batch them by size.",
+        )
+        parser.add_argument(
+            "--trim_labels",
+            type=str,
+            default=TRIM_LABELS,
+            help="Whether to cut the labels of each batch to its longest label, rather than the maximum length.",
+        )
+        parser.add_argument(
+            "--data_storage",
+            type=str,
+            default=DATA_STORAGE,
+            choices=["shards", "shared"],
+            help="Read crops from memory-mapped shards, or copy them once into a shared-memory buffer for workers.",
+        )
+        parser.add_argument(
+            "--augmented_variants",
+            type=int,
+            default=AUGMENTED_VARIANTS,
+            help="If positive, augment each train crop this many times in prepare_data, and sample from those "
+            "variants during training instead of augmenting on the fly. Takes num_variants times the train shards.",
+        )
         return parser
     
     def prepare_data(self, *args, **kwargs) -> None:
-        if (PROCESSED_DATA_DIRNAME / "_properties.json").exists():
-            return
+        """Create processed crops, labels and shards, redoing only the work whose inputs changed.
 
-        iam = BIAM()
+        A manifest records the source hash and split of each processed form, the preprocessing parameters,
+        and the inputs of each split's shards. Forms that were added or changed are reprocessed, outputs of
+        removed or moved forms are evicted, and shards are rebuilt only for splits whose contents changed.
+        """
+        iam = BIAM(argparse.Namespace(**self.args))
         iam.prepare_data()
-        
-        properties = {}
+
+        manifest = _load_manifest()
+        params = {"image_scale_factor": IMAGE_SCALE_FACTOR}
+        if manifest.get("params") != params:
+            manifest = {"params": params, "forms": {}, "shards": {}}
+        forms = manifest["forms"]
+
+        source_hashes = {id_: iam.form_hash(id_) for id_ in iam.split_by_id}
+        for id_, entry in list(forms.items()):
+            if (
+                iam.split_by_id.get(id_) != entry["split"]
+                or source_hashes[id_] != entry["hash"]
+                or not _crop_filename(id_, entry["split"]).exists()
+            ):
+                _crop_filename(id_, entry["split"]).unlink(missing_ok=True)
+                del forms[id_]
+
         for split in ["train", "val", "test"]:
-            crops, labels = get_paragraph_crops_and_labels(iam=iam, split=split)
-            save_crops_and_labels(crops=crops, labels=labels, split=split)
+            ids = [id_ for id_ in iam.ids_by_split[split] if id_ not in forms]
+            properties = process_paragraph_crops_and_labels(
+                iam=iam, split=split, ids=ids, num_workers=self.num_preprocessing_workers
+            )
+            forms.update(
+                {id_: {"split": split, "hash": source_hashes[id_], "properties": properties[id_]} for id_ in ids}
+            )
+        _save_manifest(manifest)  # Save progress before building shards, which is the slowest part to redo
 
-            properties.update(
+        with open(Path(PROCESSED_DATA_DIRNAME) / "_properties.json", "w") as f:
+            json.dump({id_: entry["properties"] for id_, entry in forms.items()}, f, indent=4)
+
+        for split in ["train", "val", "test"]:
+            shards_key = _hash_json(
                 {
-                    id_: {
-                        "crop_shape": crops[id_].size[::-1],
-                        "label_length": len(label),
-                        "num_lines": _num_lines(label),
-                    }
-                    for id_, label in labels.items()
+                    "forms": sorted((id_, forms[id_]["hash"]) for id_ in iam.ids_by_split[split]),
+                    "mapping": self.mapping,
+                    "length": self.output_dims[0],
+                    "label_mode": self.label_mode,
                 }
             )
-            
-        with open(Path(PROCESSED_DATA_DIRNAME) / "_properties.json", "w") as f:
-            json.dump(properties, f, indent=4)  
-    
+            if manifest["shards"].get(split) != shards_key or not (_shards_dirname(split) / "_index.json").exists():
+                shutil.rmtree(_shards_dirname(split), ignore_errors=True)
+                save_shards(split=split, tokenizer=self.tokenizer, length=self.output_dims[0])
+                manifest["shards"][split] = shards_key
+                _save_manifest(manifest)
+
+        if self.augmented_variants > 0:
+            variants_key = _hash_json(
+                {
+                    "forms": sorted((id_, forms[id_]["hash"]) for id_ in iam.ids_by_split["train"]),
+                    "num_variants": self.augmented_variants,
+                    "keep_aspect_ratio": self.keep_aspect_ratio,
+                    "image_shape": IMAGE_SHAPE,
+                    "upscale": False,  # with keep_aspect_ratio, crops are only ever downscaled to fit
+                    "seed": AUGMENTED_VARIANTS_SEED,
+                    "augmentation": self.trainval_transform.augmentation_kwargs,
+                }
+            )
+            if manifest.get("variants") != variants_key or not (_variants_dirname() / "_index.json").exists():
+                shutil.rmtree(_variants_dirname(), ignore_errors=True)
+                save_augmented_variants(
+                    stem=self.trainval_transform,
+                    num_variants=self.augmented_variants,
+                    num_workers=self.num_preprocessing_workers,
+                    seed=AUGMENTED_VARIANTS_SEED,
+                )
+                manifest["variants"] = variants_key
+                _save_manifest(manifest)
+
     def setup(self, stage: str = None) -> None:
         self.prepare_data()
         
         def _load_dataset(split: str, transform: Callable) -> BaseDataset:
-            crops, labels = load_processed_crops_and_labels(split)
-            Y = convert_strings_to_labels(strings=labels, mapping=self.inverse_mapping, length=self.output_dims[0])
-            return BaseDataset(crops, Y, transform=transform)
+            crops, Y = load_processed_shards(split)
+            assert Y.shape[1] == self.output_dims[0]
+            if split == "train" and self.augmented_variants > 0:
+                # variants are stored augmented and resized, so they only need to be turned into tensors
+                variants = ShardedImages(_variants_dirname())
+                if self.data_storage == "shared":
+                    variants = SharedImages(variants)
+                return BaseDataset(VariantImages(variants, self.augmented_variants), Y, transform=ImageStem())
+            dataset = BaseDataset(crops, Y, transform=transform)
+            return dataset.share_memory() if self.data_storage == "shared" else dataset
 
         validate_input_and_output_dimensions(input_dims=self.input_dims, output_dims=self.output_dims)
 
@@ -90,6 +256,31 @@ class BIAMParagraphs(BaseDataModule):
         if stage == "test" or stage is None:
             self.data_test = _load_dataset(split="test", transform=self.transform)    
             
+    def sample_sizes(self, dataset) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """Return the label length, with start and end tokens, and the image shape after the stem of each sample.
+
+        With keep_aspect_ratio, crops that fit within IMAGE_SHAPE keep their stored shape, and larger ones are
+        downscaled to fit, as by ResizeToFit.
+        """
+        lengths = label_lengths(dataset.targets, self.inverse_mapping["<P>"]).tolist()
+        if not self.keep_aspect_ratio:
+            return lengths, [IMAGE_SHAPE] * len(lengths)
+        properties = load_sample_properties()
+        shapes = [fit_shape(properties[id_]["crop_shape"], IMAGE_SHAPE) for id_ in dataset.data.ids]
+        return lengths, shapes
+
+    def train_dataloader(self):
+        if self.collate_augment is None:
+            return super().train_dataloader()
+        collate_fn = partial(collate_and_augment, augment=self.collate_augment, collate=self.collate_fn)
+        return self._dataloader(self.data_train, shuffle=True, collate_fn=collate_fn)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        """Augment train batches with batch_augment, if augment_mode is 'batch'."""
+        if self.batch_augment is not None and self.trainer is not None and self.trainer.training:
+            batch = self.batch_augment(batch[0]), *batch[1:]
+        return batch
+
     def __repr__(self) -> str:
         """Print info about the dataset."""
         basic = (
@@ -115,51 +306,109 @@ def validate_input_and_output_dimensions(
     assert output_dims is not None and output_dims[0] >= properties["label_length"]["max"] + 2
 
             
-def get_paragraph_crops_and_labels(
-    iam: BIAM, split: str, scale_factor=IMAGE_SCALE_FACTOR
-) -> Tuple[Dict[str, Image.Image], Dict[str, str]]:
-    """Create BIAM paragraph crops and labels for a given split, with resizing."""
-    crops = {}
-    labels = {}
-    for iam_id in iam.ids_by_split[split]:
-        image = iam.load_image(iam_id)
-        
-        crops[iam_id] = image
-        
-        # Resize the cropped image
-        crops[iam_id] = resize_image(crops[iam_id], scale_factor=scale_factor)
-        
-        # Get the paragraph string for the given BIAM form ID
-        labels[iam_id] = iam.paragraph_string_by_id[iam_id]
-        
-    return crops, labels
-
-def save_crops_and_labels(crops: Dict[str, Image.Image], labels: Dict[str, str], split: str):
-    """Save crops, labels, and shapes of crops of a split for the BIAM dataset."""
+def process_paragraph_crops_and_labels(
+    iam: BIAM, split: str, ids: Sequence[str] = None, num_workers: int = 0, scale_factor=IMAGE_SCALE_FACTOR
+) -> Dict[str, dict]:
+    """Create, resize and save BIAM paragraph crops and labels for a given split, returning properties of each.
+
+    Labels are saved for the whole split, but crops only for ids, if passed. Forms are streamed through a pool
+    of num_workers processes (or processed in this one, if num_workers <= 1), each of which loads, resizes and
+    writes a single crop at a time.
+    """
     (Path(PROCESSED_DATA_DIRNAME) / split).mkdir(parents=True, exist_ok=True)
 
+    labels = {id_: iam.paragraph_string_by_id[id_] for id_ in iam.ids_by_split[split]}
     with open(_labels_filename(split), "w", encoding="utf-8") as f:
         json.dump(labels, f, indent=4, ensure_ascii=False)
 
-    for id_, crop in crops.items():
-        crop.save(_crop_filename(id_, split))
-        
-def load_processed_crops_and_labels(split: str) -> Tuple[Sequence[Image.Image], Sequence[str]]:
-    """Load processed crops and labels for the given split."""
+    ids = list(labels) if ids is None else ids
+
+    save_crop = partial(_save_paragraph_crop, split=split, scale_factor=scale_factor)
+    if num_workers <= 1:
+        _init_crop_worker(iam)
+        crop_shapes = dict(map(save_crop, ids))
+    else:
+        with multiprocessing.Pool(num_workers, initializer=_init_crop_worker, initargs=(iam,)) as pool:
+            crop_shapes = dict(pool.imap_unordered(save_crop, ids))
+
+    return {
+        id_: {
+            "crop_shape": crop_shapes[id_],
+            "label_length": len(labels[id_]),
+            "num_lines": _num_lines(labels[id_]),
+        }
+        for id_ in ids
+    }
+
+
+_worker_iam = None  # BIAM instance used by the current crop-saving process
+
+
+def _init_crop_worker(iam: BIAM) -> None:
+    global _worker_iam
+    _worker_iam = iam
+
+
+def _save_paragraph_crop(iam_id: str, split: str, scale_factor: int) -> Tuple[str, Tuple[int, int]]:
+    """Load, resize and save the crop of a single BIAM form, returning its id and crop shape."""
+    crop = resize_image(_worker_iam.load_image(iam_id), scale_factor=scale_factor)
+    crop.save(_crop_filename(iam_id, split))
+    return iam_id, crop.size[::-1]
+
+def save_shards(split: str, tokenizer: Tokenizer, length: int) -> None:
+    """Pack the processed crops of a split into memory-mapped shards, and save its labels pre-tokenized."""
     with open(_labels_filename(split), "r", encoding="utf-8") as f:
         labels = json.load(f)
 
     sorted_ids = sorted(labels.keys())
-    ordered_crops = [Image.open(_crop_filename(id_, split)).convert("L") for id_ in sorted_ids]
-    ordered_labels = [labels[id_] for id_ in sorted_ids]
+    crops = (Image.open(_crop_filename(id_, split)) for id_ in sorted_ids)
+    _shards_dirname(split).mkdir(parents=True, exist_ok=True)
+    Y = tokenizer.encode([labels[id_] for id_ in sorted_ids], length=length)
+    np.save(_shards_dirname(split) / "_labels.npy", Y.numpy().astype(np.int16), allow_pickle=False)
+    write_image_shards(ids=sorted_ids, images=crops, dirname=_shards_dirname(split))
+
+
+def save_augmented_variants(stem: ParagraphStem, num_variants: int, num_workers: int = 0, seed: int = 0) -> None:
+    """Write num_variants augmentations of each train crop into memory-mapped shards, for VariantImages.
+
+    Each variant is generated with its own seed, so the store does not depend on the number of workers.
+    """
+    crops = ShardedImages(_shards_dirname("train"))
+    tasks = [(variant, index) for variant in range(num_variants) for index in range(len(crops))]
+    augment = partial(_augment_crop, crops=crops, pil_transforms=stem.pil_transforms, seed=seed)
+    if num_workers <= 1:
+        write_image_shards(ids=crops.ids * num_variants, images=map(augment, tasks), dirname=_variants_dirname())
+        return
+    with multiprocessing.Pool(num_workers) as pool:
+        images = pool.imap(augment, tasks, chunksize=4)  # in order, as the shards are written
+        write_image_shards(ids=crops.ids * num_variants, images=images, dirname=_variants_dirname())
+
+
+def _augment_crop(task: Tuple[int, int], crops: ShardedImages, pil_transforms: Callable, seed: int) -> Image.Image:
+    """Return variant number variant of the augmented train crop at index, for a task (variant, index)."""
+    variant, index = task
+    torch.manual_seed(seed + variant * len(crops) + index)
+    return pil_transforms(crops[index])
+
+
+def load_processed_shards(split: str) -> Tuple[ShardedImages, torch.Tensor]:
+    """Load memory-mapped crops and pre-tokenized labels for the given split."""
+    crops = ShardedImages(_shards_dirname(split))
+    labels = torch.from_numpy(np.load(_shards_dirname(split) / "_labels.npy").astype(np.int64))
+
+    assert len(crops) == len(labels)
+    return crops, labels
+
+
+def load_sample_properties() -> Dict[str, dict]:
+    """Return the crop_shape, label_length and num_lines of each processed id."""
+    with open(Path(PROCESSED_DATA_DIRNAME) / "_properties.json", "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    assert len(ordered_crops) == len(ordered_labels)
-    return ordered_crops, ordered_labels 
 
 def get_dataset_properties() -> dict:
     """Return properties describing the overall dataset."""
-    with open(Path(PROCESSED_DATA_DIRNAME) / "_properties.json", "r", encoding="utf-8") as f:
-        properties = json.load(f)
+    properties = load_sample_properties()
 
     def _get_property_values(key: str) -> list:
         return [_[key] for _ in properties.values()]
@@ -180,6 +429,34 @@ def _labels_filename(split: str) -> Path:
     """Return filename of processed labels."""
     return Path(PROCESSED_DATA_DIRNAME) / split / "_labels.json"        
 
+def _load_manifest() -> dict:
+    """Return the manifest of processed outputs, or an empty one if nothing was processed yet."""
+    if not _manifest_filename().exists():
+        return {}
+    with open(_manifest_filename(), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(manifest: dict) -> None:
+    with open(_manifest_filename(), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+
+def _hash_json(obj) -> str:
+    """Return SHA256 checksum of the JSON serialization of obj, with values JSON lacks, e.g. enums, as strings."""
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def _manifest_filename() -> Path:
+    """Return filename of the manifest of processed outputs."""
+    return Path(PROCESSED_DATA_DIRNAME) / "_manifest.json"
+
+def _shards_dirname(split: str) -> Path:
+    """Return directory of the memory-mapped shards of a split."""
+    return Path(PROCESSED_DATA_DIRNAME) / "shards" / split
+
+
+def _variants_dirname() -> Path:
+    """Return directory of the memory-mapped shards of pre-augmented train crops."""
+    return Path(PROCESSED_DATA_DIRNAME) / "shards" / "train_variants"
+
 def _crop_filename(id_: str, split: str) -> Path:
     """Return filename of processed crop."""
     return Path(PROCESSED_DATA_DIRNAME) / split / f"{id_}.png"
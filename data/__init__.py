@@ -7,4 +7,4 @@ sys.path.append(PARENT_DIR)
 
 from data.data_util import BaseDataset
 from data.base_data_module import BaseDataModule
-
+from data.bangla_emnist import BanglaEMNIST
@@ -0,0 +1,258 @@
+"""BanglaEMNIST DataModule: 28x28 handwritten Bangla graphemes and digits, converted from parquet shards."""
+import argparse
+import csv
+import json
+from pathlib import Path
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple
+import zlib
+
+import numpy as np
+from PIL import Image
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.base_data_module import BaseDataModule, load_and_print_info
+from data.data_util import BaseDataset, split_dataset
+import metadata.BanglaEMNIST as metadata
+from stems.image import ArrayStem
+
+PROCESSED_DATA_DIRNAME = metadata.PROCESSED_DATA_DIRNAME
+PROCESSED_DATA_FILENAME = metadata.PROCESSED_DATA_FILENAME
+INPUT_SHAPE = metadata.INPUT_SHAPE
+
+TRAIN_FRAC = 0.9  # of the train split kept for training, the rest is used for validation
+TEST_PERCENT = 10  # percentage of images, picked by a hash of their id, held out for testing
+INK_THRESHOLD = 64  # pixels above this, after inverting to white on black, are part of the character
+CROP_MARGIN = 4  # pixels of background kept around the ink of a character before resizing
+PARQUET_BATCH_ROWS = 1024  # rows converted at a time, which bounds the memory used in prepare_data
+H5_CHUNK_ROWS = 1024  # images per compressed HDF5 chunk
+
+
+class BanglaEMNIST(BaseDataModule):
+    """Handwritten Bangla graphemes and digits, as 28x28 white-on-black images, in the style of EMNIST.
+
+    prepare_data streams the raw parquet shards one record batch at a time, reading only the id and pixel columns,
+    and appends the converted images to chunked, compressed datasets of PROCESSED_DATA_FILENAME. These are then
+    unpacked chunk by chunk into uncompressed .npy files, which setup memory-maps, so that samples are served as
+    views into the page cache shared by all workers, and the dataset is never held in memory as a whole.
+    """
+
+    def __init__(self, args: argparse.Namespace = None):
+        super().__init__(args)
+        self.mapping = metadata.MAPPING
+        self.inverse_mapping = {v: k for k, v in enumerate(self.mapping)}
+        self.input_dims = metadata.DIMS
+        self.output_dims = metadata.OUTPUT_DIMS
+        self.transform = ArrayStem()
+
+    def prepare_data(self, *args, **kwargs) -> None:
+        """Convert the raw parquet shards to HDF5, and unpack that to memory-mappable arrays, if out of date."""
+        source_key = _source_key()
+        if _read_h5_source_key() != source_key:
+            convert_parquet_to_h5(self.inverse_mapping, source_key)
+        if _read_arrays_source_key() != source_key:
+            shutil.rmtree(_arrays_dirname(), ignore_errors=True)
+            unpack_h5_to_arrays(source_key)
+
+    def setup(self, stage: str = None) -> None:
+        self.prepare_data()
+
+        if stage == "fit" or stage is None:
+            data_trainval = BaseDataset(*load_processed_arrays("train"), transform=self.transform)
+            self.data_train, self.data_val = split_dataset(base_dataset=data_trainval, fraction=TRAIN_FRAC, seed=42)
+
+        if stage == "test" or stage is None:
+            self.data_test = BaseDataset(*load_processed_arrays("test"), transform=self.transform)
+
+    def __repr__(self) -> str:
+        basic = (
+            "BanglaEMNIST Dataset\n"
+            f"Num classes: {len(self.mapping)}\n"
+            f"Input dims : {self.input_dims}\n"
+            f"Output dims: {self.output_dims}\n"
+        )
+        data = f"Train/val/test sizes: {len(self.data_train)}, {len(self.data_val)}, {len(self.data_test)}\n"
+        return basic + data
+
+
+def convert_parquet_to_h5(inverse_mapping: Dict[str, int], source_key: str) -> None:
+    """Convert the raw parquet shards and label CSVs into the train and test datasets of PROCESSED_DATA_FILENAME.
+
+    Only one record batch of PARQUET_BATCH_ROWS rows is decoded at a time, and the file is written under a
+    temporary name and renamed when complete, so an interrupted conversion is redone rather than used.
+    """
+    import h5py
+
+    labels = {
+        **_read_csv_labels(metadata.RAW_CSV_ALPHA_FILE, metadata.RAW_CSV_ALPHA_LABEL_COLUMN, inverse_mapping),
+        **_read_csv_labels(metadata.RAW_CSV_NUM_FILE, metadata.RAW_CSV_NUM_LABEL_COLUMN, inverse_mapping),
+    }
+    Path(PROCESSED_DATA_DIRNAME).mkdir(parents=True, exist_ok=True)
+    temp_filename = Path(PROCESSED_DATA_FILENAME).with_suffix(".h5.partial")
+    num_unlabeled = 0
+    with h5py.File(temp_filename, "w") as f:
+        for split in ["train", "test"]:
+            f.create_dataset(
+                f"x_{split}",
+                shape=(0, *INPUT_SHAPE),
+                maxshape=(None, *INPUT_SHAPE),
+                dtype=np.uint8,
+                chunks=(H5_CHUNK_ROWS, *INPUT_SHAPE),
+                compression="gzip",
+                shuffle=True,
+            )
+            f.create_dataset(f"y_{split}", shape=(0,), maxshape=(None,), dtype=np.int16, chunks=(H5_CHUNK_ROWS,))
+        for filename in [*metadata.RAW_DATA_ALPHA_FILE, metadata.RAW_DATA_NUM_FILE]:
+            for ids, images in iter_parquet_images(filename):
+                keep = [ind for ind, id_ in enumerate(ids) if id_ in labels]
+                num_unlabeled += len(ids) - len(keep)
+                by_split = {"train": [], "test": []}
+                for ind in keep:
+                    by_split["test" if _is_test_id(ids[ind]) else "train"].append(ind)
+                for split, inds in by_split.items():
+                    if inds:
+                        _append(f[f"x_{split}"], np.stack([process_character(images[ind]) for ind in inds]))
+                        _append(f[f"y_{split}"], np.array([labels[ids[ind]] for ind in inds], dtype=np.int16))
+        f.attrs["source_key"] = source_key
+    os.replace(temp_filename, PROCESSED_DATA_FILENAME)
+    if num_unlabeled:
+        print(f"Skipped {num_unlabeled} images without a label in the mapping")
+
+
+def iter_parquet_images(filename: Path, batch_rows: int = PARQUET_BATCH_ROWS) -> Iterator[Tuple[List[str], np.ndarray]]:
+    """Yield the ids and (rows, height, width) uint8 pixels of a raw parquet shard, one record batch at a time.
+
+    Only the id column and the pixel columns, which are named by their flat index, are read.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(filename)
+    pixel_columns = [name for name in parquet_file.schema_arrow.names if name.isdigit()]
+    shape = _raw_image_shape(len(pixel_columns))
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=[metadata.RAW_ID_COLUMN, *pixel_columns]):
+        # columns are copied contiguously, then transposed once into rows of pixels
+        pixels = np.empty((len(pixel_columns), batch.num_rows), dtype=np.uint8)
+        for ind in range(len(pixel_columns)):
+            pixels[ind] = batch.column(ind + 1).to_numpy(zero_copy_only=False)
+        yield batch.column(0).to_pylist(), np.ascontiguousarray(pixels.T).reshape(-1, *shape)
+
+
+def process_character(pixels: np.ndarray) -> np.ndarray:
+    """Turn a raw black-on-white character into INPUT_SHAPE white-on-black pixels, cropped to its ink and centered."""
+    pixels = 255 - pixels
+    rows, cols = np.nonzero(pixels > INK_THRESHOLD)
+    if len(rows):
+        pixels = pixels[rows.min() : rows.max() + 1, cols.min() : cols.max() + 1]
+    size = max(pixels.shape) + 2 * CROP_MARGIN
+    square = np.zeros((size, size), dtype=np.uint8)
+    top, left = (size - pixels.shape[0]) // 2, (size - pixels.shape[1]) // 2
+    square[top : top + pixels.shape[0], left : left + pixels.shape[1]] = pixels
+    image = Image.fromarray(square).resize(INPUT_SHAPE[::-1], resample=Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def unpack_h5_to_arrays(source_key: str) -> None:
+    """Copy the datasets of PROCESSED_DATA_FILENAME into uncompressed .npy files, one HDF5 chunk at a time."""
+    import h5py
+
+    _arrays_dirname().mkdir(parents=True, exist_ok=True)
+    with h5py.File(PROCESSED_DATA_FILENAME, "r") as f:
+        for name, dataset in f.items():
+            array = np.lib.format.open_memmap(
+                _arrays_dirname() / f"{name}.npy", mode="w+", dtype=dataset.dtype, shape=dataset.shape
+            )
+            for start in range(0, len(dataset), dataset.chunks[0]):
+                array[start : start + dataset.chunks[0]] = dataset[start : start + dataset.chunks[0]]
+            array.flush()
+            del array
+    # Write the index last, so its existence marks complete arrays
+    with open(_arrays_dirname() / "_index.json", "w") as f:
+        json.dump({"source_key": source_key}, f)
+
+
+def load_processed_arrays(split: str) -> Tuple[np.ndarray, torch.Tensor]:
+    """Load the memory-mapped (N, height, width) images and the labels of a split."""
+    x = np.load(_arrays_dirname() / f"x_{split}.npy", mmap_mode="r")
+    y = torch.from_numpy(np.load(_arrays_dirname() / f"y_{split}.npy").astype(np.int64))
+    assert len(x) == len(y)
+    return x, y
+
+
+def _read_csv_labels(filename: Path, label_column: str, inverse_mapping: Dict[str, int]) -> Dict[str, int]:
+    """Return the mapping index of the label of each image id in a raw CSV file, skipping unknown labels."""
+    labels = {}
+    with open(filename, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            label = row[label_column]
+            if label.isascii() and label.isdigit():
+                label = chr(ord("০") + int(label))  # digits are labeled by their value
+            if label in inverse_mapping:
+                labels[row[metadata.RAW_ID_COLUMN]] = inverse_mapping[label]
+    return labels
+
+
+def _raw_image_shape(num_pixels: int) -> Tuple[int, int]:
+    """Return the (height, width) of raw images with num_pixels pixel columns, which are either alpha or square."""
+    if num_pixels == np.prod(metadata.RAW_ALPHA_IMAGE_SHAPE):
+        return metadata.RAW_ALPHA_IMAGE_SHAPE
+    side = int(round(num_pixels ** 0.5))
+    if side * side != num_pixels:
+        raise ValueError(f"Cannot infer the image shape of {num_pixels} pixel columns")
+    return side, side
+
+
+def _is_test_id(id_: str) -> bool:
+    """Return whether an image is in the test split, decided by its id alone so it never changes split."""
+    return zlib.crc32(id_.encode("utf-8")) % 100 < TEST_PERCENT
+
+
+def _append(dataset, values: np.ndarray) -> None:
+    dataset.resize(len(dataset) + len(values), axis=0)
+    dataset[-len(values) :] = values
+
+
+def _source_key() -> str:
+    """Return a stamp of the raw files and conversion parameters, which changes whenever any of them does."""
+    stamps = []
+    for filename in [
+        *metadata.RAW_DATA_ALPHA_FILE,
+        metadata.RAW_DATA_NUM_FILE,
+        metadata.RAW_CSV_ALPHA_FILE,
+        metadata.RAW_CSV_NUM_FILE,
+    ]:
+        stat = Path(filename).stat()
+        stamps.append([Path(filename).name, stat.st_size, stat.st_mtime_ns])
+    params = [INPUT_SHAPE, TEST_PERCENT, INK_THRESHOLD, CROP_MARGIN, len(metadata.MAPPING)]
+    return f"{zlib.crc32(json.dumps([stamps, params]).encode('utf-8')):08x}"
+
+
+def _read_h5_source_key() -> Optional[str]:
+    if not Path(PROCESSED_DATA_FILENAME).exists():
+        return None
+    import h5py
+
+    with h5py.File(PROCESSED_DATA_FILENAME, "r") as f:
+        return f.attrs.get("source_key")
+
+
+def _read_arrays_source_key() -> Optional[str]:
+    if not (_arrays_dirname() / "_index.json").exists():
+        return None
+    with open(_arrays_dirname() / "_index.json", "r") as f:
+        return json.load(f)["source_key"]
+
+
+def _arrays_dirname() -> Path:
+    """Return directory of the uncompressed, memory-mappable arrays unpacked from PROCESSED_DATA_FILENAME."""
+    return Path(PROCESSED_DATA_DIRNAME) / "arrays"
+
+
+if __name__ == "__main__":
+    load_and_print_info(BanglaEMNIST)
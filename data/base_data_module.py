@@ -1,20 +1,29 @@
 """Base DataModule class."""
 import argparse
+import math
 import os
 import sys
 from pathlib import Path
-from typing import Collection, Tuple, Union
+from typing import Collection, List, Optional, Tuple, Union
 
 import pytorch_lightning as pl
 import torch
 from torch.utils.data import ConcatDataset, DataLoader
 import multiprocessing
+import random
+
+import numpy as np
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
-from data.data_util import BaseDataset
+from data.data_util import BaseDataset, BucketBatchSampler
+
+
+def _aspect_bucket(height: int, width: int) -> int:
+    """Return the bucket of images with aspect ratios close to that of a (height, width) image."""
+    return round(math.log(width / height) / ASPECT_BUCKET_WIDTH)
 
 
 def load_and_print_info(data_module_class) -> None:
@@ -27,6 +36,11 @@ def load_and_print_info(data_module_class) -> None:
 
 
 BATCH_SIZE = 16
+BUCKET_BATCHES = "false"
+PERSISTENT_WORKERS = "true"
+PIN_MEMORY = "auto"
+ASPECT_BUCKET_WIDTH = 0.25  # images whose log aspect ratios round to the same multiple of this are bucketed together
+LENGTH_BUCKET_WIDTH = 32  # then label lengths in the same multiple of this, then samples are sorted by image size
 DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 NUM_AVAIL_CPUS = multiprocessing.cpu_count()
 NUM_AVAIL_GPUS = torch.cuda.device_count()
@@ -49,6 +63,11 @@ class BaseDataModule(pl.LightningDataModule):
         self.args = vars(args) if args is not None else {}
         self.batch_size = self.args.get("batch_size", BATCH_SIZE)
         self.num_workers = self.args.get("num_workers", DEFAULT_NUM_WORKERS)
+        self.persistent_workers = str(self.args.get("persistent_workers", PERSISTENT_WORKERS)).lower() == "true"
+        self.prefetch_factor = self.args.get("prefetch_factor", None)
+        self.pin_memory = str(self.args.get("pin_memory", PIN_MEMORY)).lower()
+        self.bucket_batches = str(self.args.get("bucket_batches", BUCKET_BATCHES)).lower() == "true"
+        self.max_tokens = self.args.get("max_tokens", None)
 
         self.device = self.args.get("device", DEFAULT_DEVICE)
         
@@ -57,6 +76,9 @@ class BaseDataModule(pl.LightningDataModule):
         else:
             self.on_gpu = False    
 
+        # Subclasses whose samples cannot be stacked as they are set a collate function here
+        self.collate_fn = None
+
         # Make sure to set the variables below in subclasses
         self.input_dims: Tuple[int, ...]
         self.output_dims: Tuple[int, ...]
@@ -84,6 +106,37 @@ class BaseDataModule(pl.LightningDataModule):
             default=DEFAULT_NUM_WORKERS,
             help=f"Number of additional processes to load data. Default is {DEFAULT_NUM_WORKERS}.",
         )
+        parser.add_argument(
+            "--persistent_workers",
+            type=str,
+            default=PERSISTENT_WORKERS,
+            help="Whether to keep loader worker processes alive across epochs, rather than starting new ones.",
+        )
+        parser.add_argument(
+            "--prefetch_factor",
+            type=int,
+            default=None,
+            help="Number of batches loaded in advance by each worker. Default is torch's default, 2.",
+        )
+        parser.add_argument(
+            "--pin_memory",
+            type=str,
+            default=PIN_MEMORY,
+            choices=["auto", "true", "false"],
+            help="Whether to load batches into pinned memory; 'auto' pins them when training on a GPU.",
+        )
+        parser.add_argument(
+            "--bucket_batches",
+            type=str,
+            default=BUCKET_BATCHES,
+            help="Whether to batch samples of similar label length and image size together, to reduce padding.",
+        )
+        parser.add_argument(
+            "--max_tokens",
+            type=int,
+            default=None,
+            help="If passed, bucket batches and size them to at most this many padded label tokens, not batch_size.",
+        )
         parser.add_argument(
             "--device",
             type=str,
@@ -98,29 +151,75 @@ class BaseDataModule(pl.LightningDataModule):
         return {"input_dims": self.input_dims, "output_dims": self.output_dims, "mapping": self.mapping}
 
 
-    def train_dataloader(self):
-        return DataLoader(
-            self.data_train,
-            shuffle=True,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.on_gpu
+    def sample_sizes(self, dataset) -> Optional[Tuple[List[int], List[Tuple[int, int]]]]:
+        """Return the label length and image (height, width) of each sample of dataset, or None if unknown.
+
+        Override in subclasses that support bucketed batches.
+        """
+        return None
+
+    def batch_sampler(self, dataset, shuffle: bool):
+        """Return a sampler of index batches for dataset, or None to batch it by batch_size.
+
+        With bucket_batches or max_tokens, samples are sorted into buckets of similar image aspect ratio, then label
+        length, then by image size, using sample_sizes, and each batch is made from a single bucket. Aspect ratio
+        comes first, as portrait and landscape images batched together pad out to the full square.
+        """
+        if not self.bucket_batches and self.max_tokens is None:
+            return None
+        sizes = self.sample_sizes(dataset)
+        if sizes is None:
+            raise ValueError(f"{type(self).__name__} does not support bucketed batches")
+        lengths, shapes = sizes
+        sort_keys = [
+            (_aspect_bucket(height, width), length // LENGTH_BUCKET_WIDTH, height, width, length)
+            for length, (height, width) in zip(lengths, shapes)
+        ]
+        return BucketBatchSampler(
+            sort_keys, batch_size=self.batch_size, shuffle=shuffle, lengths=lengths, max_tokens=self.max_tokens
         )
 
-    def val_dataloader(self):
+    def _pin_memory(self) -> bool:
+        """Return whether to pin batches, which with pin_memory 'auto' depends on the device trained on."""
+        if self.pin_memory != "auto":
+            return self.pin_memory == "true"
+        if self.trainer is not None:
+            return self.trainer.strategy.root_device.type == "cuda"
+        return self.on_gpu
+
+    def _dataloader(self, dataset, shuffle: bool, collate_fn=None) -> DataLoader:
+        """Return a loader of dataset, collating batches with collate_fn, if passed, rather than self.collate_fn."""
+        batch_sampler = self.batch_sampler(dataset, shuffle=shuffle)
+        if batch_sampler is not None:
+            batching = {"batch_sampler": batch_sampler}
+        else:
+            batching = {"shuffle": shuffle, "batch_size": self.batch_size}
+        workers = {}
+        if self.num_workers > 0:
+            workers = {"persistent_workers": self.persistent_workers, "worker_init_fn": seed_worker}
+            if self.prefetch_factor is not None:
+                workers["prefetch_factor"] = self.prefetch_factor
         return DataLoader(
-            self.data_val,
-            shuffle=False,
-            batch_size=self.batch_size,
+            dataset,
             num_workers=self.num_workers,
-            pin_memory=self.on_gpu
+            pin_memory=self._pin_memory(),
+            collate_fn=collate_fn if collate_fn is not None else self.collate_fn,
+            **batching,
+            **workers,
         )
 
+    def train_dataloader(self):
+        return self._dataloader(self.data_train, shuffle=True)
+
+    def val_dataloader(self):
+        return self._dataloader(self.data_val, shuffle=False)
+
     def test_dataloader(self):
-        return DataLoader(
-            self.data_test,
-            shuffle=False,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            pin_memory=self.on_gpu
-        )
+        return self._dataloader(self.data_test, shuffle=False)
+
+
+def seed_worker(worker_id: int) -> None:
+    """Seed numpy and random in a loader worker from its torch seed, which torch sets differently per worker."""
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
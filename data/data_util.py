@@ -1,12 +1,18 @@
 """Base Dataset class."""
-from typing import Any, Dict, List, Callable, Sequence, Tuple, Union
+import functools
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Callable, Sequence, Tuple, Union
 
+import numpy as np
 from PIL import Image
 import torch
 import re
 
 SequenceOrTensor = Union[Sequence, torch.Tensor]
 
+SHARD_SIZE = 256 * 1024 ** 2  # maximum bytes of pixels per shard file
+
 
 class BaseDataset(torch.utils.data.Dataset):
     """Base Dataset class that simply processes data and targets through optional transforms.
@@ -64,27 +70,296 @@ class BaseDataset(torch.utils.data.Dataset):
 
         return datum, target
 
+    def share_memory(self) -> "BaseDataset":
+        """Move the images of data into a single shared-memory buffer, see SharedImages, and return self."""
+        if not isinstance(self.data, SharedImages):
+            self.data = SharedImages(self.data)
+        return self
+
+
+class ShardedImages(Sequence):
+    """Read-only sequence of grayscale PIL images, stored as raw uint8 pixels in memory-mapped shard files.
+
+    Shards are opened lazily in each process and are not pickled, so DataLoader workers share
+    the pixels through the OS page cache instead of each holding their own copy.
+
+    Parameters
+    ----------
+    dirname
+        directory written by write_image_shards
+    """
+
+    def __init__(self, dirname: Union[Path, str]) -> None:
+        self.dirname = Path(dirname)
+        with open(self.dirname / "_index.json", "r") as f:
+            index = json.load(f)
+        self.ids = index["ids"]
+        self.shard_filenames = index["shards"]
+        self.entries = index["entries"]  # (shard, offset, height, width) per image
+        self._shards = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> Image.Image:
+        return Image.fromarray(self.array(index))
+
+    def array(self, index: int) -> np.ndarray:
+        """Return the (height, width) pixels of an image as a read-only view into its shard."""
+        if self._shards is None:
+            self._shards = [np.memmap(self.dirname / name, dtype=np.uint8, mode="r") for name in self.shard_filenames]
+        shard, offset, height, width = self.entries[index]
+        return self._shards[shard][offset : offset + height * width].reshape(height, width)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+
+class SharedImages(Sequence):
+    """Read-only sequence of grayscale PIL images, packed as uint8 pixels into one shared-memory buffer.
+
+    The pixels and a table of (offset, height, width) per image are torch tensors in shared memory,
+    so DataLoader workers map the same buffer instead of each receiving a pickled copy of every image.
+
+    Parameters
+    ----------
+    images
+        PIL images, or a ShardedImages whose pixels are copied without decoding them to PIL images
+    """
+
+    def __init__(self, images: Sequence) -> None:
+        self.ids = getattr(images, "ids", None)
+
+        def _pixels(index: int) -> np.ndarray:
+            if hasattr(images, "array"):
+                return images.array(index)
+            return np.asarray(images[index].convert("L"), dtype=np.uint8)
+
+        def _shape(index: int) -> Tuple[int, int]:
+            if hasattr(images, "array"):
+                return images.array(index).shape
+            return images[index].height, images[index].width
+
+        shapes = [_shape(index) for index in range(len(images))]
+        sizes = torch.tensor([height * width for height, width in shapes], dtype=torch.long)
+        offsets = torch.cumsum(sizes, dim=0) - sizes
+        self.entries = torch.cat([offsets[:, None], torch.tensor(shapes, dtype=torch.long).view(-1, 2)], dim=1)
+        self.entries.share_memory_()  # (N, 3) offset, height, width per image
+        self.buffer = torch.empty(int(sizes.sum()), dtype=torch.uint8).share_memory_()
+        buffer = self.buffer.numpy()
+        for index, (offset, size) in enumerate(zip(offsets.tolist(), sizes.tolist())):
+            buffer[offset : offset + size] = _pixels(index).reshape(-1)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> Image.Image:
+        return Image.fromarray(self.array(index))
+
+    def array(self, index: int) -> np.ndarray:
+        """Return the (height, width) pixels of an image as a view into the shared buffer."""
+        offset, height, width = self.entries[index].tolist()
+        return self.buffer.numpy()[offset : offset + height * width].reshape(height, width)
+
+
+class VariantImages(Sequence):
+    """Read-only sequence of images that each have several stored variants, returning a random one on access.
+
+    Parameters
+    ----------
+    images
+        num_variants * N images, such as a ShardedImages, where image variant * N + index is a variant of index
+    num_variants
+        Number of variants of each image
+    """
+
+    def __init__(self, images: Sequence, num_variants: int) -> None:
+        if len(images) % num_variants:
+            raise ValueError("The number of images must be a multiple of num_variants")
+        self.images = images
+        self.num_variants = num_variants
+        self.num_images = len(images) // num_variants
+        ids = getattr(images, "ids", None)
+        self.ids = ids[: self.num_images] if ids is not None else None
+
+    def __len__(self) -> int:
+        return self.num_images
+
+    def _variant_index(self, index: int) -> int:
+        if not 0 <= index < self.num_images:
+            raise IndexError(index)
+        return int(torch.randint(self.num_variants, ())) * self.num_images + index
+
+    def __getitem__(self, index: int) -> Image.Image:
+        return self.images[self._variant_index(index)]
+
+    def array(self, index: int) -> np.ndarray:
+        """Return the pixels of a random variant of an image."""
+        return self.images.array(self._variant_index(index))
+
+
+def write_image_shards(
+    ids: Sequence[str], images: Iterable[Image.Image], dirname: Union[Path, str], shard_size: int = SHARD_SIZE
+) -> None:
+    """Write images as concatenated grayscale uint8 pixels into shard files, with an index, for ShardedImages.
+
+    Images are consumed one at a time, so only a single decoded image is held in memory.
+    """
+    dirname = Path(dirname)
+    dirname.mkdir(parents=True, exist_ok=True)
+    shard_filenames, entries = [], []
+    shard_file, offset = None, 0
+    try:
+        for image in images:
+            pixels = np.asarray(image.convert("L"), dtype=np.uint8)
+            if shard_file is None or (offset > 0 and offset + pixels.size > shard_size):
+                if shard_file is not None:
+                    shard_file.close()
+                shard_filenames.append(f"shard_{len(shard_filenames):03d}.bin")
+                shard_file, offset = open(dirname / shard_filenames[-1], "wb"), 0
+            shard_file.write(pixels.tobytes())
+            entries.append([len(shard_filenames) - 1, offset, *pixels.shape])
+            offset += pixels.size
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    if len(entries) != len(ids):
+        raise ValueError("Images and ids must be of equal length")
+    # Write the index last, so its existence marks a complete store
+    with open(dirname / "_index.json", "w") as f:
+        json.dump({"ids": list(ids), "shards": shard_filenames, "entries": entries}, f)
+
+
+class Tokenizer:
+    """Converts strings to and from label sequences, with one mapping entry per character or special token.
+
+    The special sequences "&garb", "&under", "&eng" and "&deg" become the tokens "<G>", "<U>", "<ENG>" and "<DEG>",
+    the characters "<", ">", "G", "U" and "E" are dropped elsewhere, and characters missing from the mapping
+    become padding. Characters are encoded through a lookup table indexed by code point.
+
+    Parameters
+    ----------
+    mapping
+        sequence of tokens, whose indices are their labels
+    """
+
+    ALIASES = {"&garb": "<G>", "&under": "<U>", "&eng": "<ENG>", "&deg": "<DEG>"}
+    DROPPED_CHARACTERS = "<>GUE"
+    _DROP = -1
+
+    def __init__(self, mapping: Sequence[str]) -> None:
+        self.mapping = list(mapping)
+        self.inverse_mapping = {token: ind for ind, token in enumerate(self.mapping)}
+        self.start_index = self.inverse_mapping["<S>"]
+        self.end_index = self.inverse_mapping["<E>"]
+        self.padding_index = self.inverse_mapping["<P>"]
+
+        self._alias_pattern = re.compile("|".join(re.escape(alias) for alias in self.ALIASES))
+        self._special_pattern = re.compile(f"({'|'.join(re.escape(token) for token in self.ALIASES.values())})")
+
+        characters = [token for token in self.inverse_mapping if len(token) == 1] + list(self.DROPPED_CHARACTERS)
+        self._table = np.full(max(map(ord, characters)) + 1, self.padding_index, dtype=np.int64)
+        for token, ind in self.inverse_mapping.items():
+            if len(token) == 1:
+                self._table[ord(token)] = ind
+        for character in self.DROPPED_CHARACTERS:
+            self._table[ord(character)] = self._DROP
+        self._tokens = np.array(self.mapping, dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.mapping)
+
+    def encode_string(self, string: str) -> np.ndarray:
+        """Return the labels of a string, including start and end tokens."""
+        string = self._alias_pattern.sub(lambda match: self.ALIASES[match.group()], string)
+        pieces = self._special_pattern.split(string)  # special tokens at odd indices
+        labels = [np.array([self.start_index])]
+        for ind, piece in enumerate(pieces):
+            if ind % 2:
+                labels.append(np.array([self.inverse_mapping.get(piece, self.padding_index)]))
+            elif piece:
+                labels.append(self._encode_piece(piece))
+        labels.append(np.array([self.end_index]))
+        return np.concatenate(labels)
+
+    def _encode_piece(self, piece: str) -> np.ndarray:
+        """Return the labels of a string without special tokens."""
+        codes = np.frombuffer(piece.encode("utf-32-le"), dtype=np.uint32)
+        labels = np.where(
+            codes < len(self._table), self._table[np.minimum(codes, len(self._table) - 1)], self.padding_index
+        )
+        return labels[labels != self._DROP]
+
+    def encode(self, strings: Sequence[str], length: int) -> torch.Tensor:
+        """Return (len(strings), length) labels of strings, padded after their end tokens."""
+        labels = np.full((len(strings), length), self.padding_index, dtype=np.int64)
+        for i, string in enumerate(strings):
+            string_labels = self.encode_string(string)
+            if len(string_labels) > length:
+                raise ValueError(f"String {i} has {len(string_labels)} labels, more than length {length}")
+            labels[i, : len(string_labels)] = string_labels
+        return torch.from_numpy(labels)
+
+    def decode(self, labels: SequenceOrTensor, ignore: bool = True) -> List[str]:
+        """Return the strings of a (B, S) batch of labels, optionally without start, end and padding tokens."""
+        labels = labels.cpu().numpy() if isinstance(labels, torch.Tensor) else np.asarray(labels)
+        ignored = [self.start_index, self.end_index, self.padding_index] if ignore else []
+        return ["".join(self._tokens[row[~np.isin(row, ignored)]]) for row in labels.reshape(-1, labels.shape[-1])]
+
+
+class GraphemeTokenizer(Tokenizer):
+    """Tokenizer that encodes text by greedy longest match against all tokens of the mapping.
+
+    Multi-character tokens of the mapping, such as conjuncts and vowel-sign combinations, become a single label
+    instead of one label per character, which shortens label sequences. It also keeps characters that only occur
+    within such tokens, e.g. combining signs, which Tokenizer encodes as padding. Special tokens, dropped characters
+    and text matching no token are otherwise handled as by Tokenizer.
+    """
+
+    _END = ""  # key of the label of the token ending at a trie node
+
+    def __init__(self, mapping: Sequence[str]) -> None:
+        super().__init__(mapping)
+        self._trie: Dict[str, Any] = {}
+        for token, ind in self.inverse_mapping.items():
+            if not token or any(character in token for character in self.DROPPED_CHARACTERS):
+                continue
+            node = self._trie
+            for character in token:
+                node = node.setdefault(character, {})
+            node[self._END] = ind
+
+    def _encode_piece(self, piece: str) -> np.ndarray:
+        labels = []
+        start = 0
+        while start < len(piece):
+            if piece[start] in self.DROPPED_CHARACTERS:
+                start += 1
+                continue
+            node, label, end = self._trie, self.padding_index, start + 1
+            for ind in range(start, len(piece)):
+                node = node.get(piece[ind])
+                if node is None:
+                    break
+                if self._END in node:
+                    label, end = node[self._END], ind + 1
+            labels.append(label)
+            start = end
+        return np.array(labels, dtype=np.int64)
+
+
 def convert_strings_to_labels(strings: List[str], mapping: Dict[str, int], length: int) -> torch.Tensor:
-    labels = torch.ones((len(strings), length), dtype=torch.long) * mapping["<P>"]
-    for i, string in enumerate(strings):
-        string = string.replace("&garb", "<G>")
-        string = string.replace("&under", "<U>")
-        string = string.replace("&eng", "<ENG>")
-        string = string.replace("&deg", "<DEG>")
-        
-        tokens = re.findall(r"(\s+|<G>|<U>|<ENG>|<DEG>|[^\s<GUE>]+)", string)  # Split the modified string
-        
-        char_tokens = []
-        for token in tokens:
-            if token in ["<G>", "<U>", "<ENG>", "<DEG>"]:
-                char_tokens.append(token)
-            else:
-                char_tokens.extend(list(token))  # Split the word into characters
-                
-        tokens = ["<S>", *char_tokens,"<E>"]  # Add the special start token
-        for ii, token in enumerate(tokens):
-            labels[i, ii] = mapping.get(token, mapping["<P>"])  # Use mapping["<P>"] if token not in mapping
-    return labels
+    """Return (len(strings), length) labels of strings, given a mapping from tokens to labels. See Tokenizer."""
+    return _cached_tokenizer(tuple(sorted(mapping, key=mapping.get))).encode(strings, length)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_tokenizer(mapping: Tuple[str, ...]) -> Tokenizer:
+    return Tokenizer(mapping)
+
 
 def split_dataset(base_dataset: BaseDataset, fraction: float, seed: int) -> Tuple[BaseDataset, BaseDataset]:
     """
@@ -102,4 +377,154 @@ def resize_image(image: Image.Image, scale_factor: int) -> Image.Image:
     """Resize image by scale factor."""
     if scale_factor == 1:
         return image
-    return image.resize((image.width // scale_factor, image.height // scale_factor), resample=Image.BILINEAR)
\ No newline at end of file
+    return image.resize((image.width // scale_factor, image.height // scale_factor), resample=Image.BILINEAR)
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batch together samples of similar size, so that little of each batch is padding.
+
+    Indices are taken in chunks of bucket_size samples, in random order if shuffle, and each chunk is sorted
+    by sort_keys before being cut into batches. Samples with equal keys keep their random order, and the
+    batches are yielded in random order if shuffle.
+
+    Batches have batch_size samples or, if max_tokens is given, as many samples as fit in a budget of
+    max_tokens padded tokens, i.e. batch size times the largest of the batch's lengths.
+
+    Parameters
+    ----------
+    sort_keys
+        One sortable value per sample of the dataset, e.g. its label length and image size
+    batch_size
+        Number of samples per batch, if max_tokens is None
+    shuffle
+        Whether to shuffle samples within and across buckets and batches across the epoch
+    bucket_size
+        Number of samples per sorted chunk; larger values give more uniform batches but less randomness
+    lengths
+        Number of tokens of each sample, required with max_tokens
+    max_tokens
+        If given, the maximum number of padded tokens per batch, instead of a fixed batch_size
+    """
+
+    def __init__(
+        self,
+        sort_keys: Sequence,
+        batch_size: int = None,
+        shuffle: bool = True,
+        bucket_size: int = 2048,
+        lengths: Sequence[int] = None,
+        max_tokens: int = None,
+    ) -> None:
+        super().__init__()
+        if max_tokens is None and batch_size is None:
+            raise ValueError("Either batch_size or max_tokens must be given")
+        if max_tokens is not None and lengths is None:
+            raise ValueError("lengths must be given with max_tokens")
+        self.sort_keys = list(sort_keys)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.lengths = list(lengths) if lengths is not None else None
+        self.max_tokens = max_tokens
+        self._next_batches = None  # batches of the coming epoch, once its length was asked for
+
+    def _split(self, chunk: List[int]) -> List[List[int]]:
+        if self.max_tokens is None:
+            return [chunk[i : i + self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+        batches, batch, max_length = [], [], 0
+        for index in chunk:
+            length = max(max_length, self.lengths[index])
+            if batch and (len(batch) + 1) * length > self.max_tokens:
+                batches.append(batch)
+                batch, length = [], self.lengths[index]
+            batch.append(index)
+            max_length = length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _batches(self) -> List[List[int]]:
+        num_samples = len(self.sort_keys)
+        indices = torch.randperm(num_samples).tolist() if self.shuffle else list(range(num_samples))
+        batches = []
+        for start in range(0, num_samples, self.bucket_size):
+            chunk = sorted(indices[start : start + self.bucket_size], key=lambda index: self.sort_keys[index])
+            batches.extend(self._split(chunk))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def __iter__(self):
+        batches = self._next_batches if self._next_batches is not None else self._batches()
+        self._next_batches = None
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self._next_batches is None:
+            self._next_batches = self._batches()
+        return len(self._next_batches)
+
+
+def pad_images(images: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Pad (C, H, W) images of different sizes with zeros at the bottom and right into a single batch.
+
+    Returns
+    -------
+    images
+        (B, C, H, W) batch, with H and W the largest image height and width
+    image_sizes
+        (B, 2) original height and width of each image
+    """
+    image_sizes = torch.tensor([image.shape[-2:] for image in images], dtype=torch.long)
+    height, width = image_sizes.max(dim=0).values.tolist()
+    batch = images[0].new_zeros((len(images), images[0].shape[0], height, width))
+    for ind, (image, (image_height, image_width)) in enumerate(zip(images, image_sizes.tolist())):
+        batch[ind, :, :image_height, :image_width] = image
+    return batch, image_sizes
+
+
+def collate_and_augment(
+    batch: Sequence[Tuple[torch.Tensor, Any]], augment: Callable, collate: Callable = None
+) -> Tuple[torch.Tensor, ...]:
+    """Collate (image, target) pairs with collate, then augment the collated images with augment as a batch.
+
+    collate defaults to torch's default_collate, and may return extra elements after images and targets.
+    """
+    collate = collate if collate is not None else torch.utils.data.default_collate
+    images, *rest = collate(batch)
+    return (augment(images), *rest)
+
+
+def collate_padded_images(batch: Sequence[Tuple[torch.Tensor, torch.Tensor]]) -> Tuple[torch.Tensor, ...]:
+    """Collate (image, target) pairs of images with different sizes into padded images, targets and image sizes."""
+    images, targets = zip(*batch)
+    images, image_sizes = pad_images(images)
+    return images, torch.stack(targets), image_sizes
+
+
+def label_lengths(targets: torch.Tensor, padding_index: int) -> torch.Tensor:
+    """Return the (B,) lengths of (B, S) targets, padded at the end, up to and including their last non-padding token.
+
+    Unmapped characters are encoded as padding within labels, so padding is only trailing after the last other token.
+    """
+    if targets.shape[1] == 0:
+        return targets.new_zeros(len(targets))
+    positions = torch.arange(1, targets.shape[1] + 1, device=targets.device)
+    return ((targets != padding_index) * positions).amax(dim=1)
+
+
+def trim_padding(targets: torch.Tensor, padding_index: int) -> torch.Tensor:
+    """Cut (B, S) targets, padded at the end, to the length of their longest sequence."""
+    length = int(label_lengths(targets, padding_index).max()) if len(targets) else 0
+    return targets[:, : max(length, 1)]
+
+
+def collate_trimmed_targets(
+    batch: Sequence[Tuple[Any, torch.Tensor]], padding_index: int, collate: Callable = None
+) -> Tuple[torch.Tensor, ...]:
+    """Collate (datum, target) pairs with collate, then trim the targets to the longest one of the batch.
+
+    collate defaults to torch's default_collate, and may return extra elements after data and targets.
+    """
+    collate = collate if collate is not None else torch.utils.data.default_collate
+    data, targets, *rest = collate(batch)
+    return (data, trim_padding(targets, padding_index), *rest)
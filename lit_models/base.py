@@ -127,5 +127,7 @@ class BaseImageToTextLitModel(BaseLitModel):  # pylint: disable=too-many-ancesto
         self.padding_index = self.inverse_mapping["<P>"]
 
         self.ignore_tokens = [self.start_index, self.end_index, self.padding_index]
-        self.val_cer = CharacterErrorRate(self.ignore_tokens)
-        self.test_cer = CharacterErrorRate(self.ignore_tokens)
\ No newline at end of file
+        # e.g. <G>, which count as one character each in the CER of decoded text
+        self.special_tokens = [token for token in self.mapping if len(token) > 2 and token[0] + token[-1] == "<>"]
+        self.val_cer = CharacterErrorRate(self.ignore_tokens, special_tokens=self.special_tokens)
+        self.test_cer = CharacterErrorRate(self.ignore_tokens, special_tokens=self.special_tokens)
\ No newline at end of file
@@ -1,22 +1,44 @@
 """Special-purpose metrics for tracking our model performance."""
-from typing import Sequence
+from typing import Sequence, Union
 
 import torch
 import torchmetrics
 
+SPECIAL_TOKEN_PLACEHOLDERS_START = 0xE000  # first code point of Unicode's private use area
+
 
 class CharacterErrorRate(torchmetrics.CharErrorRate):
-    """Character error rate metric, allowing for tokens to be ignored."""
+    """Character error rate metric, allowing for tokens to be ignored.
+
+    Takes (B, S) tensors of tokens, each counted as one character, or decoded strings, whose characters are counted
+    whatever the tokens they were decoded from. Each of special_tokens in strings, e.g. '<G>', counts as one
+    character, as it does among tokens.
+    """
 
-    def __init__(self, ignore_tokens: Sequence[int], *args):
+    def __init__(self, ignore_tokens: Sequence[int], *args, special_tokens: Sequence[str] = ()):
         super().__init__(*args)
         self.ignore_tokens = set(ignore_tokens)
+        # longest first, so that no special token is replaced within a longer one
+        self.special_tokens = sorted(special_tokens, key=len, reverse=True)
 
-    def update(self, preds: torch.Tensor, targets: torch.Tensor):  # type: ignore
+    def update(  # type: ignore
+        self, preds: Union[torch.Tensor, Sequence[str]], targets: Union[torch.Tensor, Sequence[str]]
+    ):
+        if not isinstance(preds, torch.Tensor):
+            preds_s = [self._replace_special_tokens(pred) for pred in preds]
+            targets_s = [self._replace_special_tokens(target) for target in targets]
+            super().update(preds_s, targets_s)
+            return
         preds_l = [[t for t in pred if t not in self.ignore_tokens] for pred in preds.tolist()]
         targets_l = [[t for t in target if t not in self.ignore_tokens] for target in targets.tolist()]
         super().update(preds_l, targets_l)
 
+    def _replace_special_tokens(self, string: str) -> str:
+        """Replace each special token of string with a single private-use character of its own."""
+        for ind, token in enumerate(self.special_tokens):
+            string = string.replace(token, chr(SPECIAL_TOKEN_PLACEHOLDERS_START + ind))
+        return string
+
 
 def test_character_error_rate():
     metric = CharacterErrorRate([0, 1])
@@ -38,5 +60,15 @@ def test_character_error_rate():
     assert metric.compute() == sum([0, 0.75, 0.5]) / 3
 
 
+def test_character_error_rate_of_strings():
+    metric = CharacterErrorRate([0, 1])
+    metric(["abcd", "ab"], ["abcd", "abcd"])  # errors will be 0 and .5
+    assert metric.compute() == 2 / 8
+
+    metric = CharacterErrorRate([0, 1], special_tokens=["<G>", "<ENG>"])
+    metric(["a<G>b", "a<ENG>", "ab"], ["a<G>b", "a<G>", "a<ENG>b"])  # errors will be 0, .5 and 1 / 3
+    assert abs(metric.compute() - 2 / 8) < 1e-6
+
+
 if __name__ == "__main__":
     test_character_error_rate()
\ No newline at end of file
@@ -1,5 +1,5 @@
 """An encoder-decoder Transformer model"""
-from typing import List, Sequence
+from typing import List, Optional, Sequence, Tuple
 
 import torch
 
@@ -10,26 +10,109 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
-from lit_models.base import BaseImageToTextLitModel
+from data.data_util import Tokenizer
+from lit_models.base import BaseImageToTextLitModel, BaseLitModel
 from lit_models.lit_models_util import replace_after
 
 
+BEAM_WIDTH = 1
+LENGTH_PENALTY = 1.0
+VAL_CER_EVERY_N_BATCHES = 1
+
+
 class TransformerLitModel(BaseImageToTextLitModel):
     """
     Generic image to text PyTorch-Lightning module that must be initialized with a PyTorch module.
 
     The module must implement an encode and decode method, and the forward method
     should be the forward pass during production inference.
+
+    If beam_width is larger than 1, inference instead uses the model's beam_search method.
+
+    Batches are (x, y) or, if their images were padded to a common size, (x, y, image_sizes).
+
+    Validation and test steps encode images once, and decode that encoding both with teacher forcing, for the
+    loss, and autoregressively, for the character error rate. The latter can be limited to every
+    val_cer_every_n_batches-th validation batch.
     """
 
     def __init__(self, model, args=None):
         super().__init__(model, args)
         self.loss_fn = torch.nn.CrossEntropyLoss(ignore_index=self.padding_index)
+        self.tokenizer = Tokenizer(self.mapping)
+
+        self.beam_width = self.args.get("beam_width", BEAM_WIDTH)
+        self.length_penalty = self.args.get("length_penalty", LENGTH_PENALTY)
+        self.max_decode_length = self.args.get("max_decode_length", None)
+        self.val_cer_every_n_batches = self.args.get("val_cer_every_n_batches", VAL_CER_EVERY_N_BATCHES)
+        if self.val_cer_every_n_batches < 1:
+            raise ValueError(f"val_cer_every_n_batches must be at least 1, got {self.val_cer_every_n_batches}")
+
+    @staticmethod
+    def add_to_argparse(parser):
+        BaseLitModel.add_to_argparse(parser)
+        parser.add_argument(
+            "--beam_width", type=int, default=BEAM_WIDTH, help="Beams kept during inference; 1 decodes greedily."
+        )
+        parser.add_argument(
+            "--length_penalty",
+            type=float,
+            default=LENGTH_PENALTY,
+            help="Exponent of the length normalization of beam scores.",
+        )
+        parser.add_argument(
+            "--max_decode_length",
+            type=int,
+            default=None,
+            help="Maximum length of beam search outputs. Default is the model's maximum output length.",
+        )
+        parser.add_argument(
+            "--val_cer_every_n_batches",
+            type=int,
+            default=VAL_CER_EVERY_N_BATCHES,
+            help="Decode autoregressively for the validation CER only on every n-th batch, n >= 1; the loss uses all.",
+        )
+        return parser
+
+    def forward(self, x, image_sizes=None):
+        return self.decode_memory(*self.encode(x, image_sizes))
+
+    def encode(self, x: torch.Tensor, image_sizes: torch.Tensor = None) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Return the (Sx, B, E) encoding of images x and its (B, Sx) memory_key_padding_mask, or None."""
+        return self.model.encode(x), self.model.memory_key_padding_mask(x, image_sizes)
+
+    def decode_memory(self, memory: torch.Tensor, memory_key_padding_mask: torch.Tensor = None) -> torch.Tensor:
+        """Return (B, Sy) predictions for encoded images, as in production, decoded greedily or with beam search."""
+        if self.beam_width > 1:
+            output_tokens, _scores = self.model.beam_search_decode(
+                memory,
+                beam_width=self.beam_width,
+                length_penalty=self.length_penalty,
+                max_length=self.max_decode_length,
+                memory_key_padding_mask=memory_key_padding_mask,
+            )
+            return output_tokens[:, 0]  # (B, Sy)
+        return self.model.greedy_decode(memory, memory_key_padding_mask)
+
+    def beam_search(self, x: torch.Tensor, image_sizes: torch.Tensor = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Decode x with beam search using the lit model's settings.
 
-    def forward(self, x):
-        return self.model(x)
-
-    def teacher_forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        Returns
+        -------
+        output_tokens
+            (B, K, Sy) beams of predictions, best beam first
+        scores
+            (B, K) length-normalized log-probabilities of the beams
+        """
+        return self.model.beam_search(
+            x,
+            beam_width=max(self.beam_width, 1),
+            length_penalty=self.length_penalty,
+            max_length=self.max_decode_length,
+            image_sizes=image_sizes,
+        )
+
+    def teacher_forward(self, x: torch.Tensor, y: torch.Tensor, image_sizes: torch.Tensor = None) -> torch.Tensor:
         """Uses provided sequence y as guide for non-autoregressive encoding-decoding of x.
 
         Parameters
@@ -38,19 +121,26 @@ class TransformerLitModel(BaseImageToTextLitModel):
             Batch of images to be encoded. See self.model.encode for shape information.
         y
             Batch of ground truth output sequences.
+        image_sizes
+            Optional (B, 2) heights and widths of the images of x, if they were padded to a common size.
 
         Returns
         -------
         torch.Tensor
             (B, C, Sy) logits
         """
-        x = self.model.encode(x)
-        output = self.model.decode(x, y)  # (Sy, B, C)
+        return self.teacher_decode(*self.encode(x, image_sizes), y)
+
+    def teacher_decode(
+        self, memory: torch.Tensor, memory_key_padding_mask: Optional[torch.Tensor], y: torch.Tensor
+    ) -> torch.Tensor:
+        """Return (B, C, Sy) logits of encoded images, as returned by self.encode, guided by y."""
+        output = self.model.decode(memory, y, memory_key_padding_mask)  # (Sy, B, C)
         return output.permute(1, 2, 0)  # (B, C, Sy)
 
     def training_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self.teacher_forward(x, y[:, :-1])
+        x, y, image_sizes = _split_batch(batch)
+        logits = self.teacher_forward(x, y[:, :-1], image_sizes)
         loss = self.loss_fn(logits, y[:, 1:])
 
         self.log("train/loss", loss)
@@ -60,48 +150,56 @@ class TransformerLitModel(BaseImageToTextLitModel):
         return outputs
 
     def validation_step(self, batch, batch_idx):
-        x, y = batch
+        x, y, image_sizes = _split_batch(batch)
+        memory, memory_key_padding_mask = self.encode(x, image_sizes)
         # compute loss as in training, for comparison
-        logits = self.teacher_forward(x, y[:, :-1])
+        logits = self.teacher_decode(memory, memory_key_padding_mask, y[:, :-1])
         loss = self.loss_fn(logits, y[:, 1:])
 
         self.log("validation/loss", loss, prog_bar=True, sync_dist=True)
 
         outputs = {"loss": loss}
 
-        # compute predictions as in production, for comparison
-        preds = self(x)
-        self.val_cer(preds, y)
-        self.log("validation/cer", self.val_cer, prog_bar=True, sync_dist=True)
+        # compute predictions as in production, for comparison, from the same encoding; the CER is of their text,
+        # so that it counts characters whatever the label mode
+        if batch_idx % self.val_cer_every_n_batches == 0:
+            preds = self.decode_memory(memory, memory_key_padding_mask)
+            self.val_cer(self.batchmap(preds), self.batchmap(y))
+            self.log("validation/cer", self.val_cer, prog_bar=True, sync_dist=True)
 
         return outputs
 
     def test_step(self, batch, batch_idx):
-        x, y = batch
+        x, y, image_sizes = _split_batch(batch)
+        memory, memory_key_padding_mask = self.encode(x, image_sizes)
         # compute loss as in training, for comparison
-        logits = self.teacher_forward(x, y[:, :-1])
+        logits = self.teacher_decode(memory, memory_key_padding_mask, y[:, :-1])
         loss = self.loss_fn(logits, y[:, 1:])
 
         self.log("test/loss", loss, prog_bar=True, sync_dist=True)
 
         outputs = {"loss": loss}
 
-        # compute predictions as in production, for comparison
-        preds = self(x)
-        self.val_cer(preds, y)
-        self.log("test/cer", self.val_cer, prog_bar=True, sync_dist=True)
+        # compute predictions as in production, for comparison, from the same encoding; the CER is of their text,
+        # so that it counts characters whatever the label mode
+        preds = self.decode_memory(memory, memory_key_padding_mask)
+        self.test_cer(self.batchmap(preds), self.batchmap(y))
+        self.log("test/cer", self.test_cer, prog_bar=True, sync_dist=True)
 
         return outputs
 
     def map(self, ks: Sequence[int], ignore: bool = True) -> str:
-        """Maps an iterable of integers to a string using the lit model's mapping."""
-        if ignore:
-            return "".join([self.mapping[k] for k in ks if k not in self.ignore_tokens])
-        else:
-            return "".join([self.mapping[k] for k in ks])
+        """Maps an iterable of integers to a string using the lit model's mapping.
+
+        Tokens are concatenated, so labels of either label mode of the data, one token per character
+        or per grapheme, decode to their text.
+        """
+        return self.tokenizer.decode([list(ks)], ignore=ignore)[0]
 
     def batchmap(self, ks: Sequence[Sequence[int]], ignore=True) -> List[str]:
         """Maps a list of lists of integers to a list of strings using the lit model's mapping."""
+        if isinstance(ks, torch.Tensor):
+            return self.tokenizer.decode(ks, ignore=ignore)
         return [self.map(k, ignore) for k in ks]
 
     def get_preds(self, logitlikes: torch.Tensor, replace_after_end: bool = True) -> torch.Tensor:
@@ -125,3 +223,11 @@ class TransformerLitModel(BaseImageToTextLitModel):
             return replace_after(raw, self.end_index, self.padding_index)  # (B, Sy)
         else:
             return raw  # (B, Sy)
+
+
+def _split_batch(batch) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """Return the images, targets and image sizes of a batch, with None sizes if its images were not padded."""
+    if len(batch) == 3:
+        return batch
+    x, y = batch
+    return x, y, None
@@ -21,6 +21,10 @@ RAW_DATA_NUM_FILE = RAW_DATA_DIRNAME / 'namta.parquet'
 RAW_CSV_ALPHA_FILE = RAW_DATA_DIRNAME / "train.csv"
 RAW_CSV_NUM_FILE = RAW_DATA_DIRNAME / "namta.csv"
 RAW_IMAGE_DIRNAME = shared.DATA_DIRNAME / "raw_images"
+RAW_ALPHA_IMAGE_SHAPE = (137, 236)  # (height, width) of the flattened pixel columns of the alpha parquet files
+RAW_ID_COLUMN = "image_id"
+RAW_CSV_ALPHA_LABEL_COLUMN = "grapheme"
+RAW_CSV_NUM_LABEL_COLUMN = "digit"
 PROCESSED_DATA_DIRNAME = shared.DATA_DIRNAME / "processed_data" / "bangla_emnist"
 PROCESSED_DATA_FILENAME = PROCESSED_DATA_DIRNAME / "BEMNIST.h5"
 ESSENTIALS_FILENAME = Path(__file__).resolve().parents[1] / "data" / "bemnist_essentials.json"
@@ -11,5 +11,6 @@ RAW_DATA_DIRNAME = shared.DATA_DIRNAME / "zip"
 ZIP_FILENAME = RAW_DATA_DIRNAME / "B_IAM.zip"
 IMAGE_DATA_DIRNAME = shared.DATA_DIRNAME / "raw_images" 
 EXTRACTED_DATASET_DIRNAME = IMAGE_DATA_DIRNAME / "B_IAM"
+INDEX_FILENAME = IMAGE_DATA_DIRNAME / "B_IAM_index.json"
 
 ###LINE_REGION_PADDING = 8  # add this many pixels around the exact coordinates
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""Post-training int8 quantization of ResnetTransformer for CPU inference."""
+import copy
+import io
+from pathlib import Path
+from typing import Iterable, Union
+
+import torch
+from torch import nn
+from torch.ao.quantization import (
+    default_dynamic_qconfig,
+    float_qparams_weight_only_qconfig,
+    get_default_qconfig_mapping,
+    quantize_dynamic,
+)
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from models.resnet_transformer import ResnetTransformer
+
+DEFAULT_BACKEND = "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+
+
+def quantize_model(
+    model: ResnetTransformer, calibration_images: Iterable[torch.Tensor], backend: str = DEFAULT_BACKEND
+) -> ResnetTransformer:
+    """Return an int8 copy of model for CPU inference, calibrating its encoder on calibration_images.
+
+    The ResNet encoder is quantized statically, with activation ranges observed while encoding the (B, Ch, H, W)
+    calibration_images. The decoder's linear layers, output layer and embedding, whose inputs vary with every
+    decoded token, are quantized dynamically. The positional encodings and attention stay in float.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    prepare_encoder(model, backend)
+    with torch.no_grad():
+        for images in calibration_images:
+            model.encode(images.cpu())
+    model.resnet = convert_fx(model.resnet)
+    quantize_decoder(model)
+    return model
+
+
+def prepare_encoder(model: ResnetTransformer, backend: str = DEFAULT_BACKEND) -> None:
+    """Insert observers for static quantization into the ResNet of model, in place."""
+    torch.backends.quantized.engine = backend
+    example_inputs = (torch.rand(1, 3, *model.input_dims[1:]),)  # encode repeats grayscale images to 3 channels
+    model.resnet = prepare_fx(model.resnet, get_default_qconfig_mapping(backend), example_inputs=example_inputs)
+
+
+def quantize_decoder(model: ResnetTransformer) -> None:
+    """Dynamically quantize the linear layers and the embedding of model, in place."""
+    qconfig_spec = {nn.Linear: default_dynamic_qconfig, nn.Embedding: float_qparams_weight_only_qconfig}
+    quantize_dynamic(model, qconfig_spec, inplace=True)
+
+
+def save_quantized_model(model: ResnetTransformer, filename: Union[Path, str], backend: str = DEFAULT_BACKEND) -> None:
+    """Save the weights and quantization parameters of a model returned by quantize_model."""
+    torch.save({"backend": backend, "state_dict": model.state_dict()}, filename)
+
+
+def load_quantized_model(model: ResnetTransformer, filename: Union[Path, str]) -> ResnetTransformer:
+    """Load a model saved by save_quantized_model into an int8 copy of float model, which sets its architecture."""
+    artifact = torch.load(filename, map_location="cpu")
+    model = copy.deepcopy(model).cpu().eval()
+    prepare_encoder(model, artifact["backend"])
+    model.resnet = convert_fx(model.resnet)  # quantization parameters are then loaded with the weights
+    quantize_decoder(model)
+    model.load_state_dict(artifact["state_dict"])
+    return model
+
+
+def serialized_size(model: nn.Module) -> int:
+    """Return the number of bytes of the serialized state_dict of model."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
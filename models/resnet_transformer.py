@@ -1,7 +1,7 @@
 """Model combining a ResNet with a Transformer for image-to-sequence tasks."""
 import argparse
 import math
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -14,7 +14,16 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
-from models.transformer_util import generate_square_subsequent_mask, PositionalEncoding, PositionalEncodingImage
+from lit_models.lit_models_util import replace_after
+from models.transformer_util import (
+    decoder_layer_step,
+    generate_square_subsequent_mask,
+    index_select_cache,
+    memory_attention_mask,
+    PositionalEncoding,
+    PositionalEncodingImage,
+    project_memory,
+)
 
 
 TF_DIM = 256
@@ -22,7 +31,11 @@ TF_FC_DIM = 1024
 TF_DROPOUT = 0.4
 TF_LAYERS = 4
 TF_NHEAD = 4
+TF_KV_CACHE = "true"
 RESNET_DIM = 512  # hard-coded
+RESNET_STRIDE = 32  # hard-coded
+
+DecodeCache = List[Tuple[torch.Tensor, ...]]  # per decoder layer: (memory_k, memory_v, self_k, self_v, memory_mask)
 
 
 class ResnetTransformer(nn.Module):
@@ -51,6 +64,7 @@ class ResnetTransformer(nn.Module):
         tf_nhead = self.args.get("tf_nhead", TF_NHEAD)
         tf_dropout = self.args.get("tf_dropout", TF_DROPOUT)
         tf_layers = self.args.get("tf_layers", TF_LAYERS)
+        self.use_kv_cache = str(self.args.get("tf_kv_cache", TF_KV_CACHE)).lower() == "true"
 
         # ## Encoder part - should output  vector sequence of length self.dim per sample
         resnet = torchvision.models.resnet18(weights=None)
@@ -61,8 +75,10 @@ class ResnetTransformer(nn.Module):
         # encoder_projection will output (B, dim, _H, _W) logits
 
         self.enc_pos_encoder = PositionalEncodingImage(
-            d_model=self.dim, max_h=self.input_dims[1], max_w=self.input_dims[2]
-        )  # Max (Ho, Wo)
+            d_model=self.dim,
+            max_h=-(-self.input_dims[1] // RESNET_STRIDE),
+            max_w=-(-self.input_dims[2] // RESNET_STRIDE),
+        )  # Max (Ho, Wo), the feature-map size of the largest input
 
         # ## Decoder part
         self.embedding = nn.Embedding(self.num_classes, self.dim)
@@ -70,7 +86,8 @@ class ResnetTransformer(nn.Module):
 
         self.dec_pos_encoder = PositionalEncoding(d_model=self.dim, max_len=self.max_output_length)
 
-        self.y_mask = generate_square_subsequent_mask(self.max_output_length)
+        # a buffer, so that the mask lives on the model's device and decode only takes a view of it
+        self.register_buffer("y_mask", generate_square_subsequent_mask(self.max_output_length), persistent=False)
 
         self.transformer_decoder = nn.TransformerDecoder(
             nn.TransformerDecoderLayer(d_model=self.dim, nhead=tf_nhead, dim_feedforward=tf_fc_dim, dropout=tf_dropout),
@@ -79,41 +96,176 @@ class ResnetTransformer(nn.Module):
 
         self.init_weights()  # This is empirically important
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, image_sizes: torch.Tensor = None) -> torch.Tensor:
         """Autoregressively produce sequences of labels from input images.
 
         Parameters
         ----------
         x
             (B, Ch, H, W) image, where Ch == 1 or Ch == 3
+        image_sizes
+            Optional (B, 2) heights and widths of the images, if they were padded to (H, W)
 
         Returns
         -------
         output_tokens
             (B, Sy) with elements in [0, C-1] where C is num_classes
         """
-        B = x.shape[0]
-        S = self.max_output_length
+        memory_key_padding_mask = self.memory_key_padding_mask(x, image_sizes)  # (B, Sx) or None
         x = self.encode(x)  # (Sx, B, E)
+        return self.greedy_decode(x, memory_key_padding_mask)
+
+    def greedy_decode(self, x: torch.Tensor, memory_key_padding_mask: torch.Tensor = None) -> torch.Tensor:
+        """Autoregressively produce sequences of labels from already encoded images.
+
+        Parameters
+        ----------
+        x
+            (Sx, B, E) images encoded as sequences of embeddings, as returned by self.encode
+        memory_key_padding_mask
+            Optional (B, Sx) mask of padding positions of x, as returned by self.memory_key_padding_mask
+
+        Returns
+        -------
+        output_tokens
+            (B, Sy) with elements in [0, C-1] where C is num_classes
+        """
+        B = x.shape[1]
+        S = self.max_output_length
 
         output_tokens = (torch.ones((B, S)) * self.padding_token).type_as(x).long()  # (B, Sy)
         output_tokens[:, 0] = self.start_token  # Set start token
+        cache = self.init_decode_cache(x, memory_key_padding_mask) if self.use_kv_cache else None
+        active = torch.arange(B, device=output_tokens.device)  # rows of output_tokens still being decoded
         for Sy in range(1, S):
-            y = output_tokens[:, :Sy]  # (B, Sy)
-            output = self.decode(x, y)  # (Sy, B, C)
-            output = torch.argmax(output, dim=-1)  # (Sy, B)
-            output_tokens[:, Sy] = output[-1]  # Set the last output token
-
-            # Early stopping of prediction loop to speed up prediction
-            if ((output_tokens[:, Sy] == self.end_token) | (output_tokens[:, Sy] == self.padding_token)).all():
+            if cache is not None:
+                output, cache = self.decode_step(output_tokens[active, Sy - 1], Sy - 1, cache)  # (B_active, C)
+                output = torch.argmax(output, dim=-1)  # (B_active,)
+            else:
+                y = output_tokens[active, :Sy]  # (B_active, Sy)
+                output = self.decode(x, y, memory_key_padding_mask)  # (Sy, B_active, C)
+                output = torch.argmax(output, dim=-1)[-1]  # (B_active,)
+            output_tokens[active, Sy] = output  # Set the last output token
+
+            # Drop finished sequences from the batch, so decoding cost follows the unfinished ones
+            finished = (output == self.end_token) | (output == self.padding_token)  # (B_active,)
+            if finished.all():
                 break
+            if finished.any():
+                keep = torch.nonzero(~finished).squeeze(1)
+                active = active[keep]
+                if cache is not None:
+                    cache = index_select_cache(cache, keep)
+                else:
+                    x = x[:, keep]  # (Sx, B_active, E)
+                    if memory_key_padding_mask is not None:
+                        memory_key_padding_mask = memory_key_padding_mask[keep]
+
+        # Set all tokens after end token to be padding
+        output_tokens = replace_after(output_tokens, self.end_token, self.padding_token)
+
+        return output_tokens  # (B, Sy)
+
+    def beam_search(
+        self,
+        x: torch.Tensor,
+        beam_width: int = 4,
+        length_penalty: float = 1.0,
+        max_length: int = None,
+        image_sizes: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Produce the beam_width most likely sequences of labels for each input image with beam search.
+
+        Beams are folded into the batch dimension, so images are encoded once and their memory is shared
+        by all of their beams. Hypotheses are ranked by their summed log-probabilities divided by
+        length ** length_penalty, where length counts the predicted tokens up to and including the end token.
+
+        Parameters
+        ----------
+        x
+            (B, Ch, H, W) image, where Ch == 1 or Ch == 3
+        beam_width
+            Number of hypotheses kept per image at each step
+        length_penalty
+            Exponent of the length normalization; 0 ranks by raw log-probability, larger values favor longer outputs
+        max_length
+            Maximum length of the output sequences, including the start token. Defaults to max_output_length.
+        image_sizes
+            Optional (B, 2) heights and widths of the images, if they were padded to (H, W)
+
+        Returns
+        -------
+        output_tokens
+            (B, K, Sy) with elements in [0, C-1] where C is num_classes and K is beam_width, best beam first
+        scores
+            (B, K) length-normalized log-probabilities of the beams
+        """
+        memory_key_padding_mask = self.memory_key_padding_mask(x, image_sizes)  # (B, Sx) or None
+        x = self.encode(x)  # (Sx, B, E)
+        return self.beam_search_decode(x, beam_width, length_penalty, max_length, memory_key_padding_mask)
+
+    def beam_search_decode(
+        self,
+        x: torch.Tensor,
+        beam_width: int = 4,
+        length_penalty: float = 1.0,
+        max_length: int = None,
+        memory_key_padding_mask: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Produce the beam_width most likely sequences of labels for already encoded images, see beam_search.
+
+        Parameters
+        ----------
+        x
+            (Sx, B, E) images encoded as sequences of embeddings, as returned by self.encode
+        memory_key_padding_mask
+            Optional (B, Sx) mask of padding positions of x, as returned by self.memory_key_padding_mask
+
+        Returns
+        -------
+        output_tokens
+            (B, K, Sy) with elements in [0, C-1] where C is num_classes and K is beam_width, best beam first
+        scores
+            (B, K) length-normalized log-probabilities of the beams
+        """
+        B, K = x.shape[1], beam_width
+        S = min(max_length or self.max_output_length, self.max_output_length)
 
-        # Set all tokens after end or padding token to be padding
+        cache = index_select_cache(
+            self.init_decode_cache(x, memory_key_padding_mask), torch.arange(B, device=x.device).repeat_interleave(K)
+        )
+        output_tokens = torch.full((B * K, S), self.padding_token, dtype=torch.long, device=x.device)  # (B * K, Sy)
+        output_tokens[:, 0] = self.start_token
+        beam_scores = torch.full((B, K), float("-inf"), device=x.device)
+        beam_scores[:, 0] = 0.0  # Only expand the first beam at the first step, since all beams start identical
+        lengths = torch.zeros(B * K, dtype=torch.long, device=x.device)
+        finished = torch.zeros(B * K, dtype=torch.bool, device=x.device)
+        batch_offsets = torch.arange(B, device=x.device)[:, None] * K  # (B, 1)
         for Sy in range(1, S):
-            ind = (output_tokens[:, Sy - 1] == self.end_token) | (output_tokens[:, Sy - 1] == self.padding_token)
-            output_tokens[ind, Sy] = self.padding_token
+            output, cache = self.decode_step(output_tokens[:, Sy - 1], Sy - 1, cache)  # (B * K, C)
+            logprobs = torch.log_softmax(output.float(), dim=-1)  # (B * K, C)
+            # Finished beams can only be extended with padding, which leaves their score unchanged
+            logprobs[finished] = float("-inf")
+            logprobs[finished, self.padding_token] = 0.0
+
+            candidate_scores = beam_scores.view(B * K, 1) + logprobs  # (B * K, C)
+            beam_scores, candidates = candidate_scores.view(B, -1).topk(K, dim=-1)  # (B, K)
+            reorder = (batch_offsets + torch.div(candidates, self.num_classes, rounding_mode="floor")).view(-1)
+            tokens = (candidates % self.num_classes).view(-1)  # (B * K,)
+
+            output_tokens = output_tokens[reorder]
+            output_tokens[:, Sy] = tokens
+            cache = index_select_cache(cache, reorder)
+            lengths = lengths[reorder] + (~finished[reorder]).long()
+            finished = finished[reorder] | (tokens == self.end_token) | (tokens == self.padding_token)
+            if finished.all():
+                break
 
-        return output_tokens  # (B, Sy)
+        scores = beam_scores / lengths.view(B, K).clamp(min=1).float() ** length_penalty  # (B, K)
+        scores, order = scores.sort(dim=-1, descending=True)
+        output_tokens = output_tokens.view(B, K, S).gather(1, order[:, :, None].expand(-1, -1, S))
+        output_tokens = replace_after(output_tokens.view(B * K, S), self.end_token, self.padding_token)
+        return output_tokens.view(B, K, S), scores
 
     def init_weights(self):
         initrange = 0.1
@@ -151,7 +303,30 @@ class ResnetTransformer(nn.Module):
         x = x.permute(2, 0, 1)  # (Sx, B, E);    Sx = Ho * Wo
         return x
 
-    def decode(self, x, y):
+    def memory_key_padding_mask(self, x: torch.Tensor, image_sizes: torch.Tensor = None) -> Optional[torch.Tensor]:
+        """Return which positions of the encoding of images x only cover padding, given their sizes before padding.
+
+        Parameters
+        ----------
+        x
+            (B, Ch, H, W) images, padded at the bottom and right
+        image_sizes
+            (B, 2) heights and widths of the images before padding, or None if the images were not padded
+
+        Returns
+        -------
+            (B, Sx) mask that is True at padding positions of the encoded sequence, or None if image_sizes is None
+        """
+        if image_sizes is None:
+            return None
+        _B, _C, H, W = x.shape
+        Ho, Wo = -(-H // RESNET_STRIDE), -(-W // RESNET_STRIDE)
+        feature_sizes = -(-image_sizes.to(x.device) // RESNET_STRIDE)  # (B, 2) feature map sizes of the images
+        rows = torch.arange(Ho, device=x.device)[None, :, None] < feature_sizes[:, 0, None, None]  # (B, Ho, 1)
+        cols = torch.arange(Wo, device=x.device)[None, None, :] < feature_sizes[:, 1, None, None]  # (B, 1, Wo)
+        return ~(rows & cols).flatten(start_dim=1)  # (B, Sx), in the order of encode
+
+    def decode(self, x, y, memory_key_padding_mask=None):
         """Decode a batch of encoded images x with guiding sequences y.
 
         During autoregressive inference, the guiding sequence will be previous predictions.
@@ -164,6 +339,8 @@ class ResnetTransformer(nn.Module):
             (Sx, B, E) images encoded as sequences of embeddings
         y
             (B, Sy) guiding sequences with elements in [0, C-1] where C is num_classes
+        memory_key_padding_mask
+            Optional (B, Sx) mask of padding positions of x, as returned by self.memory_key_padding_mask
 
         Returns
         -------
@@ -176,15 +353,76 @@ class ResnetTransformer(nn.Module):
         y = self.dec_pos_encoder(y)  # (Sy, B, E)
         Sy = y.shape[0]
 
-        # Modify the attn_mask construction to match the required shape (Sy, Sy)
+        # Slice the causal mask to the length of the guiding sequences, e.g. the longest label of a trimmed batch
         y_mask = self.y_mask[:Sy, :Sy].type_as(x)
         ##y_padding_mask = y_padding_mask.type_as(x)
         output = self.transformer_decoder(
-            tgt=y, memory=x, tgt_mask=y_mask, tgt_key_padding_mask=y_padding_mask
+            tgt=y,
+            memory=x,
+            tgt_mask=y_mask,
+            tgt_key_padding_mask=y_padding_mask,
+            memory_key_padding_mask=memory_key_padding_mask,
         )  # (Sy, B, E)
         output = self.fc(output)  # (Sy, B, C)
         return output
 
+    def init_decode_cache(self, x: torch.Tensor, memory_key_padding_mask: torch.Tensor = None) -> DecodeCache:
+        """Precompute the cross-attention keys and values of encoded images x for incremental decoding.
+
+        Parameters
+        ----------
+        x
+            (Sx, B, E) images encoded as sequences of embeddings
+        memory_key_padding_mask
+            Optional (B, Sx) mask of padding positions of x, as returned by self.memory_key_padding_mask
+
+        Returns
+        -------
+        DecodeCache
+            One (memory_k, memory_v, self_k, self_v, memory_mask) tuple per decoder layer, with empty
+            self-attention entries
+        """
+        memory_mask = memory_attention_mask(memory_key_padding_mask)  # (B, 1, 1, Sx) or None
+        cache = []
+        for layer in self.transformer_decoder.layers:
+            memory_k, memory_v = project_memory(layer.multihead_attn, x)  # (B, nhead, Sx, E // nhead)
+            empty = memory_k.new_zeros((*memory_k.shape[:2], 0, memory_k.shape[-1]))  # (B, nhead, 0, E // nhead)
+            cache.append((memory_k, memory_v, empty, empty, memory_mask))
+        return cache
+
+    def decode_step(self, y: torch.Tensor, position: int, cache: DecodeCache) -> Tuple[torch.Tensor, DecodeCache]:
+        """Decode a single new token per sequence, reusing keys and values cached from earlier steps.
+
+        Gives the same logits as the last position of self.decode(x, ys[:, :position + 1]), where ys are the
+        tokens fed to earlier steps, while only processing the newest token.
+
+        Parameters
+        ----------
+        y
+            (B,) newest tokens with elements in [0, C-1] where C is num_classes
+        position
+            Index of y within its sequence
+        cache
+            As returned by init_decode_cache or a previous call to decode_step
+
+        Returns
+        -------
+        torch.Tensor
+            (B, C) batch of logits for the token following y
+        DecodeCache
+            Updated cache, to be passed to the next call
+        """
+        y = self.embedding(y[:, None]) * math.sqrt(self.dim)  # (B, 1, E)
+        y = self.dec_pos_encoder.dropout(y + self.dec_pos_encoder.pe[position])  # (B, 1, E)
+        new_cache = []
+        for layer, layer_cache in zip(self.transformer_decoder.layers, cache):
+            y, layer_cache = decoder_layer_step(layer, y, layer_cache)
+            new_cache.append(layer_cache)
+        if self.transformer_decoder.norm is not None:
+            y = self.transformer_decoder.norm(y)
+        output = self.fc(y[:, 0])  # (B, C)
+        return output, new_cache
+
     @staticmethod
     def add_to_argparse(parser):
         parser.add_argument("--tf_dim", type=int, default=TF_DIM)
@@ -192,4 +430,10 @@ class ResnetTransformer(nn.Module):
         parser.add_argument("--tf_dropout", type=float, default=TF_DROPOUT)
         parser.add_argument("--tf_layers", type=int, default=TF_LAYERS)
         parser.add_argument("--tf_nhead", type=int, default=TF_NHEAD)
+        parser.add_argument(
+            "--tf_kv_cache",
+            type=str,
+            default=TF_KV_CACHE,
+            help="Whether to cache decoder keys and values between autoregressive steps at inference.",
+        )
         return parser
\ No newline at end of file
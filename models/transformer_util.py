@@ -1,5 +1,6 @@
 """Position Encoding and other utilities for Transformers."""
 import math
+from typing import Dict, List, Tuple
 
 import torch
 from torch import Tensor
@@ -11,16 +12,17 @@ class PositionalEncodingImage(nn.Module):
     Module used to add 2-D positional encodings to the feature-map produced by the encoder.
 
     Following https://arxiv.org/abs/2103.06450 by Sumeet Singh.
+
+    The encoding is made on demand for the largest feature-map seen so far, per device and dtype, and smaller
+    feature-maps add a view of its corner, so its size follows the actual feature-maps rather than max_h and max_w.
     """
 
-    def __init__(self, d_model: int, max_h: int = 2000, max_w: int = 2000, persistent: bool = False) -> None:
+    def __init__(self, d_model: int, max_h: int = 2000, max_w: int = 2000) -> None:
         super().__init__()
         self.d_model = d_model
         assert d_model % 2 == 0, f"Embedding depth {d_model} is not even"
-        pe = self.make_pe(d_model=d_model, max_h=max_h, max_w=max_w)  # (d_model, max_h, max_w)
-        self.register_buffer(
-            "pe", pe, persistent=persistent
-        )  # not necessary to persist in state_dict, since it can be remade
+        self.max_h, self.max_w = max_h, max_w
+        self._pe_cache: Dict[Tuple[torch.device, torch.dtype], Tensor] = {}  # not a buffer, since it can be remade
 
     @staticmethod
     def make_pe(d_model: int, max_h: int, max_w: int) -> torch.Tensor:
@@ -33,11 +35,21 @@ class PositionalEncodingImage(nn.Module):
         pe = torch.cat([pe_h, pe_w], dim=0)  # (d_model, max_h, max_w)
         return pe
 
+    def pe(self, h: int, w: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+        """Return the (d_model, h, w) encoding of a feature-map, as a view of a cached encoding at least as large."""
+        assert h <= self.max_h and w <= self.max_w, f"Feature-map ({h}, {w}) exceeds ({self.max_h}, {self.max_w})"
+        pe = self._pe_cache.get((device, dtype))
+        if pe is None or pe.shape[1] < h or pe.shape[2] < w:
+            max_h, max_w = (h, w) if pe is None else (max(h, pe.shape[1]), max(w, pe.shape[2]))
+            pe = self.make_pe(d_model=self.d_model, max_h=max_h, max_w=max_w).to(device=device, dtype=dtype)
+            self._pe_cache[(device, dtype)] = pe
+        return pe[:, :h, :w]
+
     def forward(self, x: Tensor) -> Tensor:
         """pytorch.nn.module.forward"""
         # x.shape = (B, d_model, H, W)
-        assert x.shape[1] == self.pe.shape[0]  # type: ignore
-        x = x + self.pe[:, : x.size(2), : x.size(3)]  # type: ignore
+        assert x.shape[1] == self.d_model
+        x = x + self.pe(x.size(2), x.size(3), device=x.device, dtype=x.dtype)
         return x
 
 
@@ -73,4 +85,118 @@ def generate_square_subsequent_mask(size: int) -> torch.Tensor:
     """Generate a triangular (size, size) mask."""
     mask = (torch.triu(torch.ones(size, size)) == 1).transpose(0, 1)
     mask = mask.float().masked_fill(mask == 0, float("-inf")).masked_fill(mask == 1, float(0.0))
-    return mask
\ No newline at end of file
+    return mask
+
+
+def _split_heads(x: torch.Tensor, nhead: int) -> torch.Tensor:
+    """Reshape (B, S, E) into (B, nhead, S, E // nhead)."""
+    B, S, E = x.shape
+    return x.view(B, S, nhead, E // nhead).transpose(1, 2)
+
+
+def _merge_heads(x: torch.Tensor) -> torch.Tensor:
+    """Reshape (B, nhead, S, E // nhead) into (B, S, E)."""
+    B, nhead, S, head_dim = x.shape
+    return x.transpose(1, 2).reshape(B, S, nhead * head_dim)
+
+
+def _in_projection(mha: nn.MultiheadAttention, x: torch.Tensor, index: int) -> torch.Tensor:
+    """Apply the query (index=0), key (index=1) or value (index=2) input projection of mha to (B, S, E) x."""
+    E = mha.embed_dim
+    if mha._qkv_same_embed_dim:
+        weight = mha.in_proj_weight[index * E : (index + 1) * E]
+    else:
+        weight = (mha.q_proj_weight, mha.k_proj_weight, mha.v_proj_weight)[index]
+    bias = mha.in_proj_bias[index * E : (index + 1) * E] if mha.in_proj_bias is not None else None
+    return nn.functional.linear(x, weight, bias)
+
+
+def _attend(
+    mha: nn.MultiheadAttention, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, attn_mask: torch.Tensor = None
+) -> torch.Tensor:
+    """Attend with (B, nhead, 1, Dh) queries over (B, nhead, S, Dh) keys and values, returning (B, 1, E).
+
+    attn_mask, if given, is a (B, 1, 1, S) boolean mask of the keys that can be attended to.
+    """
+    dropout_p = mha.dropout if mha.training else 0.0
+    output = nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    return mha.out_proj(_merge_heads(output))
+
+
+def memory_attention_mask(memory_key_padding_mask: torch.Tensor = None) -> torch.Tensor:
+    """Turn a (B, Sx) memory_key_padding_mask, True at padding, into the mask cached for decoder_layer_step."""
+    if memory_key_padding_mask is None:
+        return None
+    return ~memory_key_padding_mask[:, None, None, :]  # (B, 1, 1, Sx)
+
+
+def project_memory(mha: nn.MultiheadAttention, memory: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Project (Sx, B, E) encoder memory into cross-attention keys and values, each (B, nhead, Sx, E // nhead)."""
+    memory = memory.transpose(0, 1)  # (B, Sx, E)
+    k = _split_heads(_in_projection(mha, memory, 1), mha.num_heads)
+    v = _split_heads(_in_projection(mha, memory, 2), mha.num_heads)
+    return k, v
+
+
+def decoder_layer_step(
+    layer: nn.TransformerDecoderLayer, y: torch.Tensor, cache: Tuple[torch.Tensor, ...]
+) -> Tuple[torch.Tensor, Tuple[torch.Tensor, ...]]:
+    """Run a single decoding step of a TransformerDecoderLayer, reusing cached keys and values.
+
+    Equivalent to the last position of layer(tgt, memory, tgt_mask=causal_mask) over the whole prefix,
+    but only the newest token is processed.
+
+    Parameters
+    ----------
+    layer
+        Layer to run, in either post-norm or pre-norm (norm_first) configuration.
+    y
+        (B, 1, E) embedding of the newest token.
+    cache
+        (memory_k, memory_v, self_k, self_v, memory_mask) where memory_k/v are the (B, nhead, Sx, Dh) projections
+        of the encoder memory, self_k/v are the (B, nhead, Sy, Dh) projections of the previous tokens, and
+        memory_mask is None or the (B, 1, 1, Sx) mask of memory_attention_mask.
+
+    Returns
+    -------
+    y
+        (B, 1, E) output of the layer for the newest token
+    cache
+        The input cache, with the self-attention keys and values of the newest token appended.
+    """
+    memory_k, memory_v, self_k, self_v, memory_mask = cache
+    self_attn, cross_attn = layer.self_attn, layer.multihead_attn
+
+    def _self_attention_block(x):
+        nonlocal self_k, self_v
+        q = _split_heads(_in_projection(self_attn, x, 0), self_attn.num_heads)
+        self_k = torch.cat([self_k, _split_heads(_in_projection(self_attn, x, 1), self_attn.num_heads)], dim=2)
+        self_v = torch.cat([self_v, _split_heads(_in_projection(self_attn, x, 2), self_attn.num_heads)], dim=2)
+        return layer.dropout1(_attend(self_attn, q, self_k, self_v))
+
+    def _cross_attention_block(x):
+        q = _split_heads(_in_projection(cross_attn, x, 0), cross_attn.num_heads)
+        return layer.dropout2(_attend(cross_attn, q, memory_k, memory_v, attn_mask=memory_mask))
+
+    def _feed_forward_block(x):
+        x = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+        return layer.dropout3(x)
+
+    x = y
+    if layer.norm_first:
+        x = x + _self_attention_block(layer.norm1(x))
+        x = x + _cross_attention_block(layer.norm2(x))
+        x = x + _feed_forward_block(layer.norm3(x))
+    else:
+        x = layer.norm1(x + _self_attention_block(x))
+        x = layer.norm2(x + _cross_attention_block(x))
+        x = layer.norm3(x + _feed_forward_block(x))
+    return x, (memory_k, memory_v, self_k, self_v, memory_mask)
+
+
+def index_select_cache(cache: List[Tuple[torch.Tensor, ...]], index: torch.Tensor) -> List[Tuple[torch.Tensor, ...]]:
+    """Select entries along the batch dimension of every tensor in a decoding cache, e.g. to drop finished rows."""
+    return [
+        tuple(tensor.index_select(0, index) if tensor is not None else None for tensor in layer_cache)
+        for layer_cache in cache
+    ]
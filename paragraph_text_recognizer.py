@@ -0,0 +1,141 @@
+"""Recognize the text of paragraph images with an exported encoder and decoder step, without the training stack.
+
+Runs the graphs written by training/export_model.py: a TorchScript pair needs only torch, and an ONNX pair only
+onnxruntime, besides numpy and PIL.
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+CONFIG_FILENAME = "config.json"
+
+
+class ParagraphTextRecognizer:
+    """Greedily decode paragraph images with exported graphs.
+
+    The encoder graph maps (B, 1, H, W) images to the cross-attention keys and values of every decoder layer,
+    each (L, B, nhead, Sx, E // nhead). The decoder step graph maps the newest (B,) tokens, their position and
+    the keys and values of the memory and of earlier tokens to (B, C) logits and the updated self-attention cache.
+
+    Parameters
+    ----------
+    model_dirname
+        directory written by training/export_model.py
+    """
+
+    def __init__(self, model_dirname: Union[Path, str]) -> None:
+        model_dirname = Path(model_dirname)
+        with open(model_dirname / CONFIG_FILENAME, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.mapping = config["mapping"]
+        self.start_token, self.end_token = config["start_token"], config["end_token"]
+        self.padding_token = config["padding_token"]
+        self.max_output_length = config["max_output_length"]
+        self.input_dims = config["input_dims"]
+        runtime = {"torchscript": _TorchScriptGraphs, "onnx": _OnnxGraphs}[config["format"]]
+        self.graphs = runtime(model_dirname / config["encoder"], model_dirname / config["decoder_step"])
+
+    def predict(self, image: Union[str, Path, Image.Image], invert: bool = False) -> str:
+        """Return the text of a paragraph image, given as light text on a dark background, unless invert."""
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        image = image.convert("L")
+        if invert:
+            image = ImageOps.invert(image)
+        return self.decode_tokens(self.greedy_decode(self.preprocess(image)))[0]
+
+    def preprocess(self, image: Image.Image) -> np.ndarray:
+        """Resize a grayscale image to the input dims, like a non-augmenting ParagraphStem, as (1, 1, H, W) floats."""
+        _C, H, W = self.input_dims
+        image = image.resize((W, H), resample=Image.BILINEAR)
+        return (np.asarray(image, dtype=np.float32) / 255)[None, None]
+
+    def greedy_decode(self, x: np.ndarray) -> np.ndarray:
+        """Return (B, Sy) tokens for (B, 1, H, W) images, with padding after each end token."""
+        memory_k, memory_v = self.graphs.encode(x)  # (L, B, nhead, Sx, E // nhead)
+        L, B, nhead, _Sx, head_dim = memory_k.shape
+        self_k = self_v = np.zeros((L, B, nhead, 0, head_dim), dtype=memory_k.dtype)
+        tokens = np.full((B, self.max_output_length), self.padding_token, dtype=np.int64)
+        tokens[:, 0] = self.start_token
+        finished = np.zeros(B, dtype=bool)
+        for Sy in range(1, self.max_output_length):
+            position = np.array(Sy - 1, dtype=np.int64)
+            logits, self_k, self_v = self.graphs.step(tokens[:, Sy - 1], position, memory_k, memory_v, self_k, self_v)
+            tokens[:, Sy] = np.where(finished, self.padding_token, logits.argmax(axis=-1))
+            finished |= (tokens[:, Sy] == self.end_token) | (tokens[:, Sy] == self.padding_token)
+            if finished.all():
+                break
+        return tokens
+
+    def decode_tokens(self, tokens: np.ndarray) -> List[str]:
+        """Return the strings of (B, Sy) tokens, without start, end and padding tokens."""
+        ignored = {self.start_token, self.end_token, self.padding_token}
+        return ["".join(self.mapping[token] for token in row if token not in ignored) for row in tokens.tolist()]
+
+
+class _TorchScriptGraphs:
+    def __init__(self, encoder_filename: Path, decoder_step_filename: Path) -> None:
+        import torch
+
+        self.torch = torch
+        self.encoder = torch.jit.load(str(encoder_filename), map_location="cpu")
+        self.decoder_step = torch.jit.load(str(decoder_step_filename), map_location="cpu")
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, ...]:
+        with self.torch.inference_mode():
+            return tuple(output.numpy() for output in self.encoder(self.torch.from_numpy(x)))
+
+    def step(self, *inputs: np.ndarray) -> Tuple[np.ndarray, ...]:
+        with self.torch.inference_mode():
+            outputs = self.decoder_step(*(self.torch.from_numpy(np.ascontiguousarray(array)) for array in inputs))
+            return tuple(output.numpy() for output in outputs)
+
+
+class _OnnxGraphs:
+    def __init__(self, encoder_filename: Path, decoder_step_filename: Path) -> None:
+        import onnxruntime
+
+        providers = ["CPUExecutionProvider"]
+        self.encoder = onnxruntime.InferenceSession(str(encoder_filename), providers=providers)
+        self.decoder_step = onnxruntime.InferenceSession(str(decoder_step_filename), providers=providers)
+
+    @staticmethod
+    def _run(session, inputs: Sequence[np.ndarray]) -> Tuple[np.ndarray, ...]:
+        names = [graph_input.name for graph_input in session.get_inputs()]
+        return tuple(session.run(None, dict(zip(names, inputs))))
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, ...]:
+        return self._run(self.encoder, [x])
+
+    def step(self, *inputs: np.ndarray) -> Tuple[np.ndarray, ...]:
+        return self._run(self.decoder_step, inputs)
+
+
+def main():
+    """
+    Print the text of paragraph images.
+
+    Sample command:
+    ```
+    python paragraph_text_recognizer.py --model_dir=artifacts/paragraph_text_recognizer page.png
+    ```
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("filenames", nargs="+", help="Paragraph images to recognize.")
+    parser.add_argument("--model_dir", type=str, required=True, help="Directory written by export_model.py.")
+    parser.add_argument(
+        "--invert", type=str, default="false", help="Whether images have dark text on a light background."
+    )
+    args = parser.parse_args()
+
+    recognizer = ParagraphTextRecognizer(args.model_dir)
+    for filename in args.filenames:
+        print(recognizer.predict(filename, invert=args.invert.lower() == "true"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Batched tensor versions of the torchvision augmentations used on paragraph images.
+
+Random parameters are drawn from the same distributions as the corresponding torchvision transforms,
+independently for each image of a batch, and each operation runs as a single vectorized kernel.
+Geometric transforms are expressed as (B, 3, 3) homographies that map output pixel coordinates to input
+pixel coordinates, with the origin at the top-left image corner, so that they can be multiplied together
+and applied with a single resample by warp, or to a single PIL image by RandomGeometricTransform.
+"""
+from typing import Sequence, Tuple, Union
+
+from PIL import Image
+import torch
+import torch.nn.functional as F
+
+from stems.image import fit_shape
+
+Range = Union[float, Sequence[float]]
+
+
+def _to_range(value: Range, center: float = 0.0, minimum: float = None) -> Tuple[float, float]:
+    """Return value as a (min, max) range, treating a single number as a distance around center."""
+    if isinstance(value, (int, float)):
+        low, high = center - value, center + value
+    else:
+        low, high = float(value[0]), float(value[1])
+    return (low if minimum is None else max(low, minimum)), high
+
+
+def _uniform(n: int, low: float, high: float, device=None) -> torch.Tensor:
+    return torch.empty(n, dtype=torch.float64, device=device).uniform_(low, high)
+
+
+def translation_matrices(tx: torch.Tensor, ty: torch.Tensor) -> torch.Tensor:
+    """Return (B, 3, 3) homographies translating by (tx, ty)."""
+    matrices = torch.eye(3, dtype=torch.float64, device=tx.device).repeat(len(tx), 1, 1)
+    matrices[:, 0, 2] = tx
+    matrices[:, 1, 2] = ty
+    return matrices
+
+
+def scale_matrices(n: int, sx: float, sy: float, device=None) -> torch.Tensor:
+    """Return (n, 3, 3) homographies scaling coordinates by (sx, sy)."""
+    return torch.diag(torch.tensor([sx, sy, 1.0], dtype=torch.float64, device=device)).repeat(n, 1, 1)
+
+
+def random_affine_matrices(
+    n: int,
+    height: int,
+    width: int,
+    degrees: Range = 0,
+    translate: Sequence[float] = None,
+    scale: Sequence[float] = None,
+    shear: Range = None,
+    device=None,
+    **_kwargs,
+) -> torch.Tensor:
+    """Return (n, 3, 3) homographies of random affine transforms about the image center, as in RandomAffine.
+
+    Keyword arguments other than those of the affine transform itself, e.g. interpolation, are ignored.
+    """
+    angle = torch.deg2rad(_uniform(n, *_to_range(degrees), device=device))
+    tx = torch.zeros(n, dtype=torch.float64, device=device)
+    ty = torch.zeros(n, dtype=torch.float64, device=device)
+    if translate is not None:
+        tx = torch.round(_uniform(n, -translate[0] * width, translate[0] * width, device=device))
+        ty = torch.round(_uniform(n, -translate[1] * height, translate[1] * height, device=device))
+    factor = _uniform(n, *scale, device=device) if scale is not None else torch.ones_like(angle)
+    shear_x, shear_y = torch.zeros_like(angle), torch.zeros_like(angle)
+    if shear is not None:
+        shears = [-shear, shear] if isinstance(shear, (int, float)) else list(shear)
+        shear_x = torch.deg2rad(_uniform(n, shears[0], shears[1], device=device))
+        if len(shears) == 4:
+            shear_y = torch.deg2rad(_uniform(n, shears[2], shears[3], device=device))
+
+    # Inverse of translation * rotation * scale * shear, as in torchvision.transforms.functional.affine
+    a = torch.cos(angle - shear_y) / torch.cos(shear_y)
+    b = -torch.cos(angle - shear_y) * torch.tan(shear_x) / torch.cos(shear_y) - torch.sin(angle)
+    c = torch.sin(angle - shear_y) / torch.cos(shear_y)
+    d = -torch.sin(angle - shear_y) * torch.tan(shear_x) / torch.cos(shear_y) + torch.cos(angle)
+    inverse = torch.zeros(n, 3, 3, dtype=torch.float64, device=device)
+    inverse[:, 0, 0], inverse[:, 0, 1] = d / factor, -b / factor
+    inverse[:, 1, 0], inverse[:, 1, 1] = -c / factor, a / factor
+    inverse[:, 2, 2] = 1.0
+    inverse = inverse @ translation_matrices(-tx, -ty)
+
+    center = translation_matrices(
+        torch.full_like(angle, width / 2), torch.full_like(angle, height / 2)
+    )  # the affine transform is about the image center
+    return center @ inverse @ torch.linalg.inv(center)
+
+
+def random_perspective_matrices(
+    n: int, height: int, width: int, distortion_scale: float = 0.5, p: float = 0.5, device=None, **_kwargs
+) -> torch.Tensor:
+    """Return (n, 3, 3) homographies of random perspective transforms, as in RandomPerspective.
+
+    Each transform is applied with probability p, otherwise its homography is the identity.
+    """
+    dx, dy = int(distortion_scale * (width // 2)), int(distortion_scale * (height // 2))
+
+    def _randint(low, high):
+        return torch.randint(low, high, (n,), device=device).double()
+
+    endpoints = torch.stack(
+        [
+            torch.stack([_randint(0, dx + 1), _randint(0, dy + 1)], dim=-1),
+            torch.stack([_randint(width - dx - 1, width), _randint(0, dy + 1)], dim=-1),
+            torch.stack([_randint(width - dx - 1, width), _randint(height - dy - 1, height)], dim=-1),
+            torch.stack([_randint(0, dx + 1), _randint(height - dy - 1, height)], dim=-1),
+        ],
+        dim=1,
+    )  # (n, 4, 2)
+    startpoints = torch.tensor(
+        [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=torch.float64, device=device
+    ).expand(n, -1, -1)
+    matrices = perspective_matrices(startpoints, endpoints)
+
+    applied = torch.rand(n, device=device) < p
+    return torch.where(applied[:, None, None], matrices, torch.eye(3, dtype=torch.float64, device=device))
+
+
+def perspective_matrices(startpoints: torch.Tensor, endpoints: torch.Tensor) -> torch.Tensor:
+    """Return (B, 3, 3) homographies of the perspective transforms moving (B, 4, 2) startpoints to endpoints.
+
+    As torchvision.transforms.functional.perspective, the homographies map endpoints back to startpoints.
+    """
+    n = len(endpoints)
+    x, y = endpoints[..., 0].double(), endpoints[..., 1].double()
+    u, v = startpoints[..., 0].double(), startpoints[..., 1].double()
+    zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+    rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1)
+    rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1)
+    a_matrix = torch.stack([rows_u, rows_v], dim=2).view(n, 8, 8)
+    b_matrix = torch.stack([u, v], dim=2).view(n, 8, 1)
+    coeffs = torch.linalg.solve(a_matrix, b_matrix).view(n, 8)
+    return torch.cat([coeffs, torch.ones_like(coeffs[:, :1])], dim=1).view(n, 3, 3)
+
+
+def warp(images: torch.Tensor, matrices: torch.Tensor, output_shape: Tuple[int, int]) -> torch.Tensor:
+    """Resample (B, C, H, W) images once with (B, 3, 3) homographies into (B, C, *output_shape) images.
+
+    Pixels mapped from outside of the input are filled with zeros.
+    """
+    B, _C, H, W = images.shape
+    oh, ow = output_shape
+    # Rescale the homographies to map output pixel centers to the normalized [-1, 1] input coordinates of grid_sample
+    to_grid = torch.tensor([[2 / W, 0, -1], [0, 2 / H, -1], [0, 0, 1]], dtype=torch.float64, device=matrices.device)
+    m = (to_grid @ matrices).to(device=images.device, dtype=images.dtype)[:, :, :, None, None]  # (B, 3, 3, 1, 1)
+    ys = (torch.arange(oh, dtype=images.dtype, device=images.device) + 0.5)[:, None]
+    xs = torch.arange(ow, dtype=images.dtype, device=images.device) + 0.5
+    points = m[:, :, 0] * xs + m[:, :, 1] * ys + m[:, :, 2]  # (B, 3, oh, ow)
+    grid = (points[:, :2] / points[:, 2:]).permute(0, 2, 3, 1)
+    return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+
+class RandomGeometricTransform:
+    """Resize, random affine and random perspective transforms of a PIL image, with a single resample.
+
+    Equivalent to Resize(output_shape), RandomAffine(**random_affine_kwargs) and
+    RandomPerspective(**random_perspective_kwargs) in sequence, but the three transforms are composed into one
+    homography from output to input pixels, so the image is interpolated once instead of three times.
+
+    If keep_aspect_ratio, images are instead downscaled with their own aspect ratio to fit within output_shape,
+    if larger, as by ResizeToFit(output_shape).
+    """
+
+    def __init__(
+        self,
+        output_shape: Tuple[int, int],
+        random_affine_kwargs: dict,
+        random_perspective_kwargs: dict,
+        keep_aspect_ratio: bool = False,
+    ):
+        self.output_shape = output_shape
+        self.random_affine_kwargs = random_affine_kwargs
+        self.random_perspective_kwargs = random_perspective_kwargs
+        self.keep_aspect_ratio = keep_aspect_ratio
+
+    def __call__(self, image: Image.Image) -> Image.Image:
+        height, width = self.output_shape
+        if self.keep_aspect_ratio:
+            height, width = fit_shape((image.height, image.width), self.output_shape)
+        # Box-reduce by any integer factor first, as bilinear sampling alone would alias strong downscales
+        factor = max(1, min(image.width // width, image.height // height))
+        if factor > 1:
+            image = image.reduce(factor)
+
+        matrix = (
+            scale_matrices(1, image.width / width, image.height / height)
+            @ random_affine_matrices(1, height, width, **self.random_affine_kwargs)
+            @ random_perspective_matrices(1, height, width, **self.random_perspective_kwargs)
+        )[0]
+        coeffs = (matrix / matrix[2, 2]).flatten()[:8].tolist()
+        return image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BILINEAR)
+
+
+def random_brightness_contrast(images: torch.Tensor, brightness: Range = 0, contrast: Range = 0) -> torch.Tensor:
+    """Randomly adjust brightness and contrast of (B, C, H, W) images in [0, 1], in random order, as ColorJitter."""
+    B = images.shape[0]
+    brightness_factor = _uniform(B, *_to_range(brightness, center=1.0, minimum=0.0), device=images.device)
+    contrast_factor = _uniform(B, *_to_range(contrast, center=1.0, minimum=0.0), device=images.device)
+    brightness_factor = brightness_factor.to(images.dtype)[:, None, None, None]
+    contrast_factor = contrast_factor.to(images.dtype)[:, None, None, None]
+
+    def _brightness(x, index):
+        return (brightness_factor[index] * x).clamp(0, 1)
+
+    def _contrast(x, index):
+        mean = x.mean(dim=(-3, -2, -1), keepdim=True)  # images are grayscale
+        return (contrast_factor[index] * x + (1 - contrast_factor[index]) * mean).clamp(0, 1)
+
+    brightness_first = torch.rand(B, device=images.device) < 0.5
+    output = torch.empty_like(images)
+    output[brightness_first] = _contrast(_brightness(images[brightness_first], brightness_first), brightness_first)
+    contrast_first = ~brightness_first
+    output[contrast_first] = _brightness(_contrast(images[contrast_first], contrast_first), contrast_first)
+    return output
+
+
+def random_gaussian_blur(
+    images: torch.Tensor, kernel_size: Union[int, Sequence[int]] = 3, sigma: Range = (0.1, 2.0)
+) -> torch.Tensor:
+    """Blur (B, C, H, W) images with a Gaussian kernel of random standard deviation per image, as GaussianBlur."""
+    B, C, H, W = images.shape
+    kx, ky = (kernel_size, kernel_size) if isinstance(kernel_size, int) else kernel_size
+    sigma = (sigma, sigma) if isinstance(sigma, (int, float)) else sigma
+    sigma = _uniform(B, *sigma, device=images.device).to(images.dtype)
+
+    def _kernels(size):
+        x = torch.linspace(-(size - 1) / 2, (size - 1) / 2, size, dtype=images.dtype, device=images.device)
+        kernels = torch.exp(-0.5 * (x[None, :] / sigma[:, None]) ** 2)
+        return (kernels / kernels.sum(dim=1, keepdim=True))[:, None, None, None, :]  # (B, 1, 1, 1, size)
+
+    # The kernels are small, so the separable convolution is a weighted sum of shifted views of the padded batch
+    x = F.pad(images, [kx // 2, kx // 2, ky // 2, ky // 2], mode="reflect")
+    weights = _kernels(kx)
+    x = sum(weights[..., i] * x[..., i : i + W] for i in range(kx))
+    weights = _kernels(ky)
+    return sum(weights[..., i] * x[..., i : i + H, :] for i in range(ky))
+
+
+def random_adjust_sharpness(images: torch.Tensor, sharpness_factor: float, p: float = 0.5) -> torch.Tensor:
+    """Sharpen (B, C, H, W) images in [0, 1], each with probability p, as RandomAdjustSharpness."""
+    applied = torch.rand(images.shape[0], device=images.device) < p
+    x = images[applied]
+    # Smooth with the 3x3 kernel of ones with a center of 5, as a separable box sum plus the extra center weight
+    rows = x[..., :-2, :] + x[..., 1:-1, :] + x[..., 2:, :]
+    box = rows[..., :-2] + rows[..., 1:-1] + rows[..., 2:]
+    degenerate = x.clone()
+    degenerate[..., 1:-1, 1:-1] = (box + 4 * x[..., 1:-1, 1:-1]) / 13  # borders are left unchanged
+    output = images.clone()
+    output[applied] = (sharpness_factor * x + (1 - sharpness_factor) * degenerate).clamp(0, 1)
+    return output
@@ -1,7 +1,31 @@
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
 import torch
 from torchvision import transforms
 
 
+def fit_shape(shape: Tuple[int, int], max_shape: Tuple[int, int]) -> Tuple[int, int]:
+    """Return shape, scaled down with its aspect ratio to the largest (height, width) that fits within max_shape.
+
+    Shapes that already fit are returned unchanged, as upscaling would only add pixels for the encoder to process.
+    """
+    scale = min(max_shape[0] / shape[0], max_shape[1] / shape[1], 1.0)
+    return min(max(round(shape[0] * scale), 1), max_shape[0]), min(max(round(shape[1] * scale), 1), max_shape[1])
+
+
+class ResizeToFit:
+    """Downscale a PIL image to the largest size that fits within max_shape, keeping its aspect ratio, if larger."""
+
+    def __init__(self, max_shape: Tuple[int, int]):
+        self.max_shape = max_shape
+
+    def __call__(self, img: Image.Image) -> Image.Image:
+        height, width = fit_shape((img.height, img.width), self.max_shape)
+        return transforms.functional.resize(img, [height, width])
+
+
 class ImageStem:
     def __init__(self):
         self.pil_transforms = transforms.Compose([])
@@ -15,4 +39,11 @@ class ImageStem:
         with torch.no_grad():
             img = self.torch_transforms(img)
 
-        return img
\ No newline at end of file
+        return img
+
+
+class ArrayStem:
+    """Turn (H, W) uint8 pixels, such as a view into a memory-mapped array, into a (1, H, W) float tensor in [0, 1]."""
+
+    def __call__(self, pixels: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(np.array(pixels, dtype=np.float32))[None] / 255
@@ -1,3 +1,4 @@
+import torch
 import torchvision.transforms as transforms
 from PIL import Image as PILImage
 
@@ -9,19 +10,50 @@ PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
 import metadata.b_iam_paragraphs as metadata
-from stems.image import ImageStem
+from stems.augment import (
+    random_adjust_sharpness,
+    random_affine_matrices,
+    random_brightness_contrast,
+    random_gaussian_blur,
+    random_perspective_matrices,
+    RandomGeometricTransform,
+    warp,
+)
+from stems.image import ImageStem, ResizeToFit
 
 IMAGE_HEIGHT, IMAGE_WIDTH = metadata.IMAGE_HEIGHT, metadata.IMAGE_WIDTH
 IMAGE_SHAPE = metadata.IMAGE_SHAPE
 
 MAX_LABEL_LENGTH = metadata.MAX_LABEL_LENGTH
 
+COLOR_JITTER_KWARGS = {"brightness": 0.4, "contrast": 0.4}
+RANDOM_AFFINE_KWARGS = {
+    "degrees": 2,
+    "shear": 3,
+    "scale": (0.95, 1),
+    "interpolation": transforms.InterpolationMode.BILINEAR,
+}
+RANDOM_PERSPECTIVE_KWARGS = {
+    "distortion_scale": 0.2,
+    "p": 0.5,
+    "interpolation": transforms.InterpolationMode.BILINEAR,
+}
+GAUSSIAN_BLUR_KWARGS = {"kernel_size": (3, 3), "sigma": (0.1, 1.0)}
+SHARPNESS_KWARGS = {"sharpness_factor": 2, "p": 0.5}
+
+
 class ParagraphStem(ImageStem):
-    """A stem for handling images that contain a paragraph of text."""
+    """A stem for handling images that contain a paragraph of text.
+
+    Images are resized to IMAGE_SHAPE or, if keep_aspect_ratio, downscaled with their own aspect ratio to fit
+    within IMAGE_SHAPE, if larger, in which case they must be batched with padding. The keyword arguments of
+    the augmentations, if augment, are kept in augmentation_kwargs.
+    """
 
     def __init__(
         self,
         augment=False,
+        keep_aspect_ratio=False,
         color_jitter_kwargs=None,
         random_affine_kwargs=None,
         random_perspective_kwargs=None,
@@ -30,38 +62,76 @@ class ParagraphStem(ImageStem):
     ):
         super().__init__()
 
+        self.augmentation_kwargs = None
         if not augment:
-            self.pil_transforms = transforms.Compose([transforms.Resize(IMAGE_SHAPE)])
+            resize = ResizeToFit(IMAGE_SHAPE) if keep_aspect_ratio else transforms.Resize(IMAGE_SHAPE)
+            self.pil_transforms = transforms.Compose([resize])
         else:
             if color_jitter_kwargs is None:
-                color_jitter_kwargs = {"brightness": 0.4, "contrast": 0.4}
+                color_jitter_kwargs = COLOR_JITTER_KWARGS
             if random_affine_kwargs is None:
-               random_affine_kwargs = {
-                    "degrees": 2,
-                    "shear": 3,
-                    "scale": (0.95, 1),
-                "interpolation": transforms.InterpolationMode.BILINEAR
-            }
+                random_affine_kwargs = RANDOM_AFFINE_KWARGS
             if random_perspective_kwargs is None:
-               random_perspective_kwargs = {
-                    "distortion_scale": 0.2,
-                    "p": 0.5,
-                "interpolation": transforms.InterpolationMode.BILINEAR,
-            }
+                random_perspective_kwargs = RANDOM_PERSPECTIVE_KWARGS
             if gaussian_blur_kwargs is None:
-                gaussian_blur_kwargs = {"kernel_size": (3, 3), "sigma": (0.1, 1.0)}
+                gaussian_blur_kwargs = GAUSSIAN_BLUR_KWARGS
             if sharpness_kwargs is None:
-                sharpness_kwargs = {"sharpness_factor": 2, "p": 0.5}
+                sharpness_kwargs = SHARPNESS_KWARGS
+            self.augmentation_kwargs = {
+                "color_jitter": color_jitter_kwargs,
+                "random_affine": random_affine_kwargs,
+                "random_perspective": random_perspective_kwargs,
+                "gaussian_blur": gaussian_blur_kwargs,
+                "sharpness": sharpness_kwargs,
+            }
 
-            # IMAGE_SHAPE is (576, 640)
+            # IMAGE_SHAPE is (1000, 1000); resize, affine and perspective transforms are done with one resample
             self.pil_transforms = transforms.Compose(
                 [
                     transforms.ColorJitter(**color_jitter_kwargs),
-                    transforms.Resize(IMAGE_SHAPE),
-                    transforms.RandomAffine(**random_affine_kwargs),
-                    transforms.RandomPerspective(**random_perspective_kwargs),
+                    RandomGeometricTransform(
+                        IMAGE_SHAPE, random_affine_kwargs, random_perspective_kwargs, keep_aspect_ratio
+                    ),
                     transforms.GaussianBlur(**gaussian_blur_kwargs),
                     transforms.RandomAdjustSharpness(**sharpness_kwargs),
 
                 ]
-            )
\ No newline at end of file
+            )
+
+
+class ParagraphBatchAugment(torch.nn.Module):
+    """Augment collated batches of paragraph images as tensors, with the same transforms as ParagraphStem.
+
+    Takes (B, C, H, W) float images in [0, 1] that were already resized by a non-augmenting ParagraphStem.
+    Random parameters are drawn per image from the same distributions as the PIL transforms, and the affine and
+    perspective transforms are fused into a single resample.
+    """
+
+    def __init__(
+        self,
+        color_jitter_kwargs=None,
+        random_affine_kwargs=None,
+        random_perspective_kwargs=None,
+        gaussian_blur_kwargs=None,
+        sharpness_kwargs=None,
+    ):
+        super().__init__()
+        self.color_jitter_kwargs = color_jitter_kwargs or COLOR_JITTER_KWARGS
+        self.random_affine_kwargs = random_affine_kwargs or RANDOM_AFFINE_KWARGS
+        self.random_perspective_kwargs = random_perspective_kwargs or RANDOM_PERSPECTIVE_KWARGS
+        self.gaussian_blur_kwargs = gaussian_blur_kwargs or GAUSSIAN_BLUR_KWARGS
+        self.sharpness_kwargs = sharpness_kwargs or SHARPNESS_KWARGS
+
+    @torch.no_grad()
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        B, _C, H, W = images.shape
+        images = random_brightness_contrast(images, **self.color_jitter_kwargs)
+
+        # Perspective is applied after the affine transform, so its homography maps output to affine coordinates
+        matrices = random_affine_matrices(
+            B, H, W, device=images.device, **self.random_affine_kwargs
+        ) @ random_perspective_matrices(B, H, W, device=images.device, **self.random_perspective_kwargs)
+        images = warp(images, matrices, output_shape=(H, W))
+
+        images = random_gaussian_blur(images, **self.gaussian_blur_kwargs)
+        return random_adjust_sharpness(images, **self.sharpness_kwargs)
@@ -0,0 +1,72 @@
+"""Tests for data.data_util."""
+import random
+import re
+
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.data_util import collate_trimmed_targets, convert_strings_to_labels, label_lengths, Tokenizer, trim_padding
+import metadata.b_iam_paragraphs as metadata
+
+S, E, P = 0, 1, 2  # start, end and padding tokens
+
+
+def test_trim_padding_keeps_padding_within_labels():
+    # an unmapped character is encoded as padding within the first label
+    targets = torch.tensor([[S, 5, P, P, 6, E, P, P, P], [S, 5, 6, 7, E, P, P, P, P]])
+    assert label_lengths(targets, P).tolist() == [6, 5]
+    trimmed = trim_padding(targets, P)
+    assert trimmed.tolist() == [[S, 5, P, P, 6, E], [S, 5, 6, 7, E, P]]
+    assert (trimmed == E).any(dim=1).all()
+
+
+def test_collate_trimmed_targets():
+    batch = [
+        (torch.zeros(1, 2, 2), torch.tensor([S, P, 5, E, P, P])),
+        (torch.ones(1, 2, 2), torch.tensor([S, E, P, P, P, P])),
+    ]
+    images, targets = collate_trimmed_targets(batch, padding_index=P)
+    assert images.shape == (2, 1, 2, 2)
+    assert targets.tolist() == [[S, P, 5, E], [S, E, P, P]]
+
+
+def test_trim_padding_of_all_padding_keeps_one_column():
+    assert trim_padding(torch.full((2, 4), P), P).shape == (2, 1)
+
+
+def _reference_convert_strings_to_labels(strings, mapping, length):
+    """The loop convert_strings_to_labels had before it was backed by Tokenizer."""
+    labels = torch.ones((len(strings), length), dtype=torch.long) * mapping["<P>"]
+    for i, string in enumerate(strings):
+        string = string.replace("&garb", "<G>")
+        string = string.replace("&under", "<U>")
+        string = string.replace("&eng", "<ENG>")
+        string = string.replace("&deg", "<DEG>")
+        tokens = re.findall(r"(\s+|<G>|<U>|<ENG>|<DEG>|[^\s<GUE>]+)", string)
+        char_tokens = []
+        for token in tokens:
+            if token in ["<G>", "<U>", "<ENG>", "<DEG>"]:
+                char_tokens.append(token)
+            else:
+                char_tokens.extend(list(token))
+        tokens = ["<S>", *char_tokens, "<E>"]
+        for ii, token in enumerate(tokens):
+            labels[i, ii] = mapping.get(token, mapping["<P>"])
+    return labels
+
+
+def test_tokenizer_matches_reference_labels_of_fuzzed_strings():
+    rng = random.Random(0)
+    characters = sorted({c for token in metadata.MAPPING for c in token if len(token) == 1})
+    pieces = characters + ["&garb", "&under", "&eng", "&deg", "<G>", "<ENG>", "<", ">", "G", "U", "E", "x", "\n", "  "]
+    strings = ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 60))) for _ in range(500)]
+    mapping = {token: ind for ind, token in enumerate(metadata.MAPPING)}
+    expected = _reference_convert_strings_to_labels(strings, mapping, length=200)
+    assert torch.equal(Tokenizer(metadata.MAPPING).encode(strings, length=200), expected)
+    assert torch.equal(convert_strings_to_labels(strings, mapping, length=200), expected)
@@ -0,0 +1,65 @@
+"""Tests for models.resnet_transformer."""
+import argparse
+
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from models.resnet_transformer import ResnetTransformer
+
+MAPPING = ["<B>", "<S>", "<E>", "<P>", "a", "b", "c", "d"]
+DATA_CONFIG = {"input_dims": (1, 96, 128), "output_dims": (24, 1), "mapping": MAPPING}
+
+
+def _tiny_model(kv_cache: str, seed: int = 3) -> ResnetTransformer:
+    """Return a small random model, with weights scaled up so that its outputs depend on the image and end early."""
+    torch.manual_seed(0)
+    args = argparse.Namespace(tf_dim=32, tf_fc_dim=64, tf_nhead=4, tf_layers=2, tf_dropout=0.0, tf_kv_cache=kv_cache)
+    model = ResnetTransformer(data_config=DATA_CONFIG, args=args).eval()
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for param in model.transformer_decoder.parameters():
+            if param.dim() > 1:
+                param.normal_(0, 0.5)
+        model.fc.weight.normal_(0, 1)
+        model.fc.bias.zero_()
+        model.embedding.weight.normal_(0, 1)
+        model.encoder_projection.weight.normal_(0, 1)
+    return model
+
+
+def _images(num_images: int) -> torch.Tensor:
+    torch.manual_seed(1)
+    contrasts = torch.arange(1, num_images + 1, dtype=torch.float32)[:, None, None, None]
+    return torch.rand(num_images, *DATA_CONFIG["input_dims"]) ** contrasts
+
+
+def test_greedy_tokens_with_and_without_kv_cache_are_identical():
+    cached, uncached = _tiny_model("true"), _tiny_model("false")
+    x = _images(6)
+    with torch.no_grad():
+        tokens = cached(x)
+        assert torch.equal(tokens, uncached(x))
+    # some sequences end early and others run to the maximum length, so dropping finished rows is exercised too
+    lengths = (tokens != cached.padding_token).sum(dim=1)
+    assert lengths.min() < DATA_CONFIG["output_dims"][0] and lengths.max() == DATA_CONFIG["output_dims"][0]
+
+
+def test_decode_step_matches_last_position_of_decode():
+    model = _tiny_model("true")
+    x = _images(3)
+    torch.manual_seed(2)
+    ys = torch.randint(4, len(MAPPING), (3, 10))
+    ys[:, 0] = model.start_token
+    with torch.no_grad():
+        memory = model.encode(x)
+        cache = model.init_decode_cache(memory)
+        for position in range(ys.shape[1]):
+            logits, cache = model.decode_step(ys[:, position], position, cache)
+            expected = model.decode(memory, ys[:, : position + 1])[-1]
+            torch.testing.assert_close(logits, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,127 @@
+"""Benchmark train-time augmentation of paragraph images, per image with PIL versus per batch with tensors."""
+import argparse
+from functools import partial
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from stems.paragraph import ParagraphBatchAugment, ParagraphStem
+
+DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of images per batch.")
+    parser.add_argument("--num_batches", type=int, default=4, help="Number of batches to time.")
+    parser.add_argument("--page_size", type=int, default=1000, help="Height and width of the synthetic pages.")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=DEFAULT_DEVICE,
+        help="Device that batches are augmented on, as after transfer with --augment_mode=batch. On 'cpu', this "
+        "is also the cost of --augment_mode=collate in each loader worker.",
+    )
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads, if set.")
+    parser.add_argument("--output", type=str, default=None, help="If passed, write the results as JSON.")
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def synthetic_pages(num_pages: int, page_size: int, seed: int = 0) -> list:
+    """Return grayscale pages of dark horizontal strokes on a light background, roughly like handwriting."""
+    rng = np.random.default_rng(seed)
+    pages = []
+    for _ in range(num_pages):
+        page = np.full((page_size, page_size), 235, dtype=np.uint8)
+        for top in range(page_size // 20, page_size - page_size // 20, page_size // 15):
+            for _ in range(page_size // 10):
+                x, y = rng.integers(page_size // 20, page_size - page_size // 20), top + rng.integers(0, 20)
+                page[y : y + rng.integers(2, 12), x : x + rng.integers(2, 12)] = rng.integers(0, 80)
+        pages.append(Image.fromarray(page))
+    return pages
+
+
+def time_pil(pages: list, batch_size: int) -> tuple:
+    """Augment pages one by one with PIL transforms and collate them, as done in the DataLoader workers."""
+    stem = ParagraphStem(augment=True)
+    start = time.perf_counter()
+    batches = [
+        torch.stack([stem(page) for page in pages[i : i + batch_size]]) for i in range(0, len(pages), batch_size)
+    ]
+    return time.perf_counter() - start, torch.cat(batches)
+
+
+def time_batch(pages: list, batch_size: int, device: str = "cpu") -> tuple:
+    """Only resize pages one by one, then augment each collated batch with tensor operations on device.
+
+    Time spent copying batches to device is included, as it is in training.
+    """
+    stem, batch_augment = ParagraphStem(), ParagraphBatchAugment()
+    start = time.perf_counter()
+    batches = [
+        batch_augment(torch.stack([stem(page) for page in pages[i : i + batch_size]]).to(device))
+        for i in range(0, len(pages), batch_size)
+    ]
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start, torch.cat(batches).cpu()
+
+
+def main():
+    """
+    Print samples/sec of both augmentation paths, and statistics of their outputs to check their parity.
+
+    Sample command:
+    ```
+    python training/benchmark_augmentation.py --batch_size=16 --num_batches=8 --output=augmentation.json
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    torch.manual_seed(0)
+    pages = synthetic_pages(args.batch_size * args.num_batches, args.page_size)
+    results = {}
+    for name, time_augmentation in [("pil", time_pil), ("batch", partial(time_batch, device=args.device))]:
+        time_augmentation(pages[: args.batch_size], args.batch_size)  # warm up allocations
+        seconds, images = time_augmentation(pages, args.batch_size)
+        results[name] = {
+            "samples_per_second": len(pages) / seconds,
+            "mean": images.mean().item(),
+            "std": images.std().item(),
+            "dark_fraction": (images < 0.5).float().mean().item(),
+        }
+
+    print(f"batch path on {args.device}")
+    print(f"{'path':>6} {'samples/sec':>12} {'mean':>8} {'std':>8} {'dark':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:>6} {result['samples_per_second']:>12.2f} {result['mean']:>8.4f} {result['std']:>8.4f} "
+            f"{result['dark_fraction']:>8.4f}"
+        )
+
+    if args.output is not None:
+        with open(Path(args.output), "w") as f:
+            json.dump(
+                {"batch_size": args.batch_size, "num_images": len(pages), "device": args.device, "results": results},
+                f,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Benchmark how fast B_IAM paragraph batches can be loaded, across loader settings and storage backends."""
+import argparse
+import itertools
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.B_iam_paragraphs import BIAMParagraphs
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--num_workers_list", type=str, default="0,2,4", help="Comma-separated worker counts.")
+    parser.add_argument("--batch_sizes", type=str, default="4,16", help="Comma-separated batch sizes.")
+    parser.add_argument("--augment_list", type=str, default="false,true", help="Comma-separated augment_data values.")
+    parser.add_argument("--storages", type=str, default="shards,shared", help="Comma-separated data_storage values.")
+    parser.add_argument("--num_batches", type=int, default=10, help="Number of train batches loaded per setting.")
+    parser.add_argument("--num_stage_samples", type=int, default=16, help="Number of samples timed stage by stage.")
+    parser.add_argument("--output", type=str, default=None, help="If passed, write the report as JSON.")
+    data_group = parser.add_argument_group("Data Args")
+    BIAMParagraphs.add_to_argparse(data_group)
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+class TimedDataset(torch.utils.data.Dataset):
+    """Wrap a dataset to add up the seconds each loader worker spends producing samples, in shared memory."""
+
+    def __init__(self, dataset, num_workers: int):
+        self.dataset = dataset
+        self.busy_seconds = torch.zeros(max(num_workers, 1), dtype=torch.float64).share_memory_()
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        sample = self.dataset[index]
+        worker_info = torch.utils.data.get_worker_info()
+        self.busy_seconds[worker_info.id if worker_info is not None else 0] += time.perf_counter() - start
+        return sample
+
+    def __getattr__(self, name):
+        if name == "dataset":  # not set yet while unpickling, e.g. in spawned loader workers
+            raise AttributeError(name)
+        return getattr(self.dataset, name)  # e.g. targets and data, used to bucket batches
+
+
+def _make_data(args: argparse.Namespace, **overrides) -> BIAMParagraphs:
+    data = BIAMParagraphs(argparse.Namespace(**{**vars(args), **overrides}))
+    data.setup("fit")
+    return data
+
+
+def time_stages(data: BIAMParagraphs, num_samples: int, batch_size: int) -> dict:
+    """Return the mean seconds per sample of each stage of producing train batches, in the main process.
+
+    Crops are stored as raw pixels, so read covers copying them out of storage and decode covers wrapping them
+    as PIL images. augment covers the stem's PIL transforms, which only resize images without augmentation.
+    """
+    dataset, stem = data.data_train, data.data_train.transform
+    seconds = dict.fromkeys(["read", "decode", "augment", "to_tensor", "collate"], 0.0)
+    samples = []
+    indices = list(range(min(num_samples, len(dataset))))
+    for index in indices:
+        start = time.perf_counter()
+        pixels = np.array(dataset.data.array(index))  # copy, so that lazily mapped pages are actually read
+        seconds["read"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        image = Image.fromarray(pixels)
+        seconds["decode"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        image = stem.pil_transforms(image)
+        seconds["augment"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            tensor = stem.torch_transforms(stem.pil_to_tensor(image))
+        seconds["to_tensor"] += time.perf_counter() - start
+        samples.append((tensor, dataset.targets[index]))
+
+    collate = data.collate_fn if data.collate_fn is not None else torch.utils.data.default_collate
+    start = time.perf_counter()
+    for ind in range(0, len(samples), batch_size):
+        collate(samples[ind : ind + batch_size])
+    seconds["collate"] += time.perf_counter() - start
+    return {stage: total / max(len(indices), 1) for stage, total in seconds.items()}
+
+
+def time_loading(data: BIAMParagraphs, num_workers: int, num_batches: int) -> dict:
+    """Return throughput and worker utilization of loading up to num_batches train batches."""
+    data.data_train = TimedDataset(data.data_train, num_workers)
+    dataloader = data.train_dataloader()
+    num_samples, first_batch_seconds = 0, None
+    start = time.perf_counter()
+    for batch in itertools.islice(dataloader, num_batches):
+        if first_batch_seconds is None:
+            first_batch_seconds = time.perf_counter() - start
+        num_samples += len(batch[0])
+    seconds = time.perf_counter() - start
+    busy_seconds = data.data_train.busy_seconds
+    data.data_train = data.data_train.dataset
+    return {
+        "samples": num_samples,
+        "seconds": seconds,
+        "samples_per_second": num_samples / seconds,
+        "first_batch_seconds": first_batch_seconds,
+        "worker_utilization": float(busy_seconds.sum()) / (len(busy_seconds) * seconds),
+    }
+
+
+def main():
+    """
+    Print and optionally save loading throughput for every combination of the swept settings.
+
+    Sample command:
+    ```
+    python training/benchmark_data_loading.py --num_workers_list=0,4 --batch_sizes=8 --output=loading.json
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+
+    def _values(string: str) -> list:
+        return [value.strip() for value in string.split(",")]
+
+    report = {"stages": [], "loading": []}
+    print(
+        f"{'storage':>8} {'augment':>8} {'workers':>8} {'batch':>6} {'samples/sec':>12} {'first batch (s)':>16} "
+        f"{'utilization':>12}"
+    )
+    for storage, augment in itertools.product(_values(args.storages), _values(args.augment_list)):
+        data = _make_data(args, data_storage=storage, augment_data=augment, num_workers=0)
+        stages = time_stages(data, args.num_stage_samples, batch_size=int(_values(args.batch_sizes)[0]))
+        report["stages"].append({"storage": storage, "augment": augment, "seconds_per_sample": stages})
+
+        for num_workers, batch_size in itertools.product(_values(args.num_workers_list), _values(args.batch_sizes)):
+            num_workers, batch_size = int(num_workers), int(batch_size)
+            data.num_workers, data.batch_size = num_workers, batch_size
+            result = time_loading(data, data.num_workers, args.num_batches)
+            settings = {"storage": storage, "augment": augment, "num_workers": num_workers, "batch_size": batch_size}
+            report["loading"].append({**settings, **result})
+            print(
+                f"{storage:>8} {augment:>8} {data.num_workers:>8} {data.batch_size:>6} "
+                f"{result['samples_per_second']:>12.2f} {result['first_batch_seconds']:>16.2f} "
+                f"{result['worker_utilization']:>12.2f}"
+            )
+
+    print("\nseconds per sample by stage, in the main process")
+    for entry in report["stages"]:
+        timings = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in entry["seconds_per_sample"].items())
+        print(f"  storage={entry['storage']} augment={entry['augment']}: {timings}")
+
+    if args.output is not None:
+        with open(Path(args.output), "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Benchmark per-token latency of autoregressive decoding, with and without the decoder key/value cache."""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+import metadata.b_iam_paragraphs as metadata
+from models.resnet_transformer import ResnetTransformer
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of images decoded together.")
+    parser.add_argument(
+        "--max_length", type=int, default=metadata.MAX_LABEL_LENGTH, help="Number of tokens to decode."
+    )
+    parser.add_argument("--report_every", type=int, default=50, help="Print latency every this many tokens.")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads, if set.")
+    parser.add_argument("--output", type=str, default=None, help="If passed, write the latency curves as JSON.")
+    ResnetTransformer.add_to_argparse(parser)
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def time_decoding(model: ResnetTransformer, x: torch.Tensor, max_length: int, use_kv_cache: bool) -> list:
+    """Decode max_length tokens from encoded images x, never stopping early, and return per-token seconds."""
+    B = x.shape[1]
+    tokens = torch.full((B, max_length), model.padding_token, dtype=torch.long)
+    tokens[:, 0] = model.start_token
+    cache = model.init_decode_cache(x) if use_kv_cache else None
+    latencies = []
+    for Sy in range(1, max_length):
+        start = time.perf_counter()
+        if cache is not None:
+            output, cache = model.decode_step(tokens[:, Sy - 1], Sy - 1, cache)  # (B, C)
+        else:
+            output = model.decode(x, tokens[:, :Sy])[-1]  # (B, C)
+        # keep the guiding sequence free of padding, so both modes attend over the same tokens
+        tokens[:, Sy] = torch.argmax(output, dim=-1).clamp(min=model.padding_token + 1)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    """
+    Print and optionally save per-token decoding latency curves.
+
+    Sample command:
+    ```
+    python training/benchmark_decoding.py --batch_size=4 --max_length=700 --output=decoding.json
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    data_config = {
+        "input_dims": metadata.DIMS,
+        "output_dims": (args.max_length, 1),
+        "mapping": metadata.MAPPING,
+    }
+    model = ResnetTransformer(data_config=data_config, args=args).eval()
+
+    with torch.no_grad():
+        x = model.encode(torch.rand(args.batch_size, *metadata.DIMS))  # (Sx, B, E)
+        curves = {
+            "uncached": time_decoding(model, x, args.max_length, use_kv_cache=False),
+            "kv_cache": time_decoding(model, x, args.max_length, use_kv_cache=True),
+        }
+
+    print(f"{'token':>8} {'uncached (ms)':>15} {'kv_cache (ms)':>15}")
+    for ind in range(0, args.max_length - 1, args.report_every):
+        print(f"{ind + 1:>8} {curves['uncached'][ind] * 1000:>15.2f} {curves['kv_cache'][ind] * 1000:>15.2f}")
+    print(f"{'total':>8} {sum(curves['uncached']) * 1000:>15.1f} {sum(curves['kv_cache']) * 1000:>15.1f}")
+
+    if args.output is not None:
+        with open(Path(args.output), "w") as f:
+            json.dump({"batch_size": args.batch_size, "latency_seconds": curves}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Load a running inference_server.py with concurrent requests, and report its throughput and latency percentiles."""
+import argparse
+import http.client
+import json
+from pathlib import Path
+import socket
+import threading
+import time
+from typing import List
+
+import numpy as np
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from training.inference_server import HOST, PORT
+
+CONCURRENCY_LEVELS = "1,2,4,8,16"
+REQUESTS_PER_LEVEL = 64
+IMAGES_GLOB = "dataset/processed_data/B_IAM_paragraphs/test/*.png"
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix socket."""
+
+    def __init__(self, path: str) -> None:
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def _connect(args) -> http.client.HTTPConnection:
+    if args.unix_socket is not None:
+        return UnixHTTPConnection(args.unix_socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def _request(connection: http.client.HTTPConnection, method: str, path: str, body: bytes = None) -> dict:
+    connection.request(method, path, body=body)
+    response = connection.getresponse()
+    result = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed with {response.status}: {result.get('error')}")
+    return result
+
+
+def run_level(args, images: List[bytes], concurrency: int) -> dict:
+    """Send requests_per_level images from concurrency clients, each waiting for its response before the next."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    next_request = iter(range(args.requests_per_level))
+
+    def client():
+        connection = _connect(args)
+        while True:
+            with lock:
+                ind = next(next_request, None)
+            if ind is None:
+                break
+            start = time.perf_counter()
+            try:
+                _request(connection, "POST", "/predict", images[ind % len(images)])
+            except (OSError, RuntimeError, http.client.HTTPException) as error:
+                with lock:
+                    errors.append(repr(error))
+                connection.close()
+                connection = _connect(args)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    before = _request(_connect(args), "GET", "/metrics")
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    seconds = time.perf_counter() - start
+    after = _request(_connect(args), "GET", "/metrics")
+
+    latencies = np.array(latencies) if latencies else np.full(1, np.nan)
+    served = (after["requests"] - after["errors"]) - (before["requests"] - before["errors"])
+    return {
+        "concurrency": concurrency,
+        "requests": args.requests_per_level,
+        "errors": len(errors),
+        "throughput_rps": (args.requests_per_level - len(errors)) / seconds,
+        "latency_p50_seconds": float(np.percentile(latencies, 50)),
+        "latency_p99_seconds": float(np.percentile(latencies, 99)),
+        "mean_batch_size": served / max(after["batches"] - before["batches"], 1),
+    }
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--host", type=str, default=HOST, help=f"Address of the server. Default is {HOST}.")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Port of the server. Default is {PORT}.")
+    parser.add_argument(
+        "--unix_socket", type=str, default=None, help="If passed, connect to this Unix socket instead of host:port."
+    )
+    parser.add_argument(
+        "--concurrency_levels",
+        type=str,
+        default=CONCURRENCY_LEVELS,
+        help=f"Comma-separated numbers of concurrent clients. Default is {CONCURRENCY_LEVELS}.",
+    )
+    parser.add_argument(
+        "--requests_per_level",
+        type=int,
+        default=REQUESTS_PER_LEVEL,
+        help=f"Number of requests sent at each concurrency level. Default is {REQUESTS_PER_LEVEL}.",
+    )
+    parser.add_argument(
+        "--images", type=str, default=IMAGES_GLOB, help="Glob of image files to send, relative to the repo root."
+    )
+    parser.add_argument("--output", type=str, default=None, help="If passed, write the results as JSON.")
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def main():
+    """
+    Benchmark a running inference server at increasing concurrency.
+
+    Sample command:
+    ```
+    python training/inference_server.py --load_checkpoint=training/logs/model.ckpt &
+    python training/benchmark_inference_server.py --concurrency_levels=1,4,16 --requests_per_level=128
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+
+    filenames = sorted(Path(PARENT_DIR).glob(args.images))
+    if not filenames:
+        raise ValueError(f"No images match {args.images}")
+    images = [filename.read_bytes() for filename in filenames]
+
+    results = []
+    print(f"{'clients':>8} {'req/s':>8} {'p50 (s)':>8} {'p99 (s)':>8} {'batch':>6} {'errors':>7}")
+    for concurrency in [int(level) for level in args.concurrency_levels.split(",")]:
+        result = run_level(args, images, concurrency)
+        results.append(result)
+        print(
+            f"{concurrency:>8} {result['throughput_rps']:>8.2f} {result['latency_p50_seconds']:>8.3f} "
+            f"{result['latency_p99_seconds']:>8.3f} {result['mean_batch_size']:>6.2f} {result['errors']:>7}"
+        )
+
+    if args.output is not None:
+        with open(Path(args.output), "w") as f:
+            json.dump({"images": args.images, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
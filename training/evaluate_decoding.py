@@ -0,0 +1,96 @@
+"""Compare character error rate and latency of greedy and beam-search decoding on B_IAM paragraphs."""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.B_iam_paragraphs import BIAMParagraphs
+import lit_models
+from lit_models.metrics import CharacterErrorRate
+from models.resnet_transformer import ResnetTransformer
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--load_checkpoint", type=str, default=None, help="TransformerLitModel checkpoint to evaluate."
+    )
+    parser.add_argument(
+        "--beam_widths", type=str, default="1,2,4,8", help="Comma-separated beam widths; 1 decodes greedily."
+    )
+    parser.add_argument("--split", type=str, default="test", help="Split to evaluate on ('val' or 'test').")
+    parser.add_argument("--output", type=str, default=None, help="If passed, write the results as JSON.")
+
+    data_group = parser.add_argument_group("Data Args")
+    BIAMParagraphs.add_to_argparse(data_group)
+    model_group = parser.add_argument_group("Model Args")
+    ResnetTransformer.add_to_argparse(model_group)
+    lit_model_group = parser.add_argument_group("LitModel Args")
+    lit_models.TransformerLitModel.add_to_argparse(lit_model_group)
+
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def evaluate(lit_model: lit_models.TransformerLitModel, dataloader) -> dict:
+    """Return the character error rate and decoding time of lit_model's inference mode on dataloader."""
+    cer = CharacterErrorRate(lit_model.ignore_tokens, special_tokens=lit_model.special_tokens)
+    num_images, seconds = 0, 0.0
+    with torch.no_grad():
+        for batch in dataloader:
+            x, y, *image_sizes = [tensor.to(lit_model.device) for tensor in batch]
+            start = time.perf_counter()
+            preds = lit_model(x, *image_sizes)
+            seconds += time.perf_counter() - start
+            cer.update(lit_model.batchmap(preds), lit_model.batchmap(y))
+            num_images += x.shape[0]
+    return {"cer": float(cer.compute()), "seconds_per_image": seconds / max(num_images, 1)}
+
+
+def main():
+    """
+    Print the accuracy/latency trade-off of beam widths on a B_IAM paragraphs split.
+
+    Sample command:
+    ```
+    python training/evaluate_decoding.py --load_checkpoint=training/logs/model.ckpt --beam_widths=1,4 --num_workers=0
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+
+    data = BIAMParagraphs(args)
+    data.setup()
+    model = ResnetTransformer(data_config=data.config(), args=args)
+    if args.load_checkpoint is not None:
+        lit_model = lit_models.TransformerLitModel.load_from_checkpoint(args.load_checkpoint, args=args, model=model)
+    else:
+        lit_model = lit_models.TransformerLitModel(args=args, model=model)
+    lit_model.eval()
+    dataloader = data.test_dataloader() if args.split == "test" else data.val_dataloader()
+
+    results = {}
+    for beam_width in [int(width) for width in args.beam_widths.split(",")]:
+        lit_model.beam_width = beam_width
+        results[beam_width] = evaluate(lit_model, dataloader)
+        print(
+            f"beam_width={beam_width:<3} cer={results[beam_width]['cer']:.4f} "
+            f"seconds/image={results[beam_width]['seconds_per_image']:.3f}"
+        )
+
+    if args.output is not None:
+        with open(Path(args.output), "w") as f:
+            json.dump({"split": args.split, "length_penalty": args.length_penalty, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
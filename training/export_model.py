@@ -0,0 +1,235 @@
+"""Export a trained ResnetTransformer as an encoder graph and a single-step decoder graph, and verify them."""
+import argparse
+import json
+from pathlib import Path
+import time
+from typing import Tuple
+import warnings
+
+import torch
+from torch import nn
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.B_iam_paragraphs import BIAMParagraphs
+import lit_models
+from models.resnet_transformer import ResnetTransformer
+from models.transformer_util import project_memory
+from paragraph_text_recognizer import CONFIG_FILENAME, ParagraphTextRecognizer
+
+EXPORT_FORMAT = "torchscript"
+VERIFY_PAGES = 4
+ONNX_OPSET = 17
+FILENAMES = {
+    "torchscript": {"encoder": "encoder.pt", "decoder_step": "decoder_step.pt"},
+    "onnx": {"encoder": "encoder.onnx", "decoder_step": "decoder_step.onnx"},
+}
+
+
+class EncoderGraph(nn.Module):
+    """Encode (B, 1, H, W) images into the stacked (L, B, nhead, Sx, E // nhead) cross-attention keys and values.
+
+    Only holds the modules that ResnetTransformer.encode and the memory projections use, so that the graph
+    leaves out the decoder's weights.
+    """
+
+    def __init__(self, model: ResnetTransformer) -> None:
+        super().__init__()
+        self.resnet = model.resnet
+        self.encoder_projection = model.encoder_projection
+        self.enc_pos_encoder = model.enc_pos_encoder
+        self.cross_attns = nn.ModuleList(layer.multihead_attn for layer in model.transformer_decoder.layers)
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        memory = ResnetTransformer.encode(self, x)  # (Sx, B, E)
+        keys, values = zip(*(project_memory(cross_attn, memory) for cross_attn in self.cross_attns))
+        return torch.stack(keys), torch.stack(values)
+
+
+class DecoderStepGraph(nn.Module):
+    """Decode one token per sequence with ResnetTransformer.decode_step, with the cache as explicit tensors.
+
+    Takes the (B,) newest tokens, their 0-d position, the stacked memory keys and values of EncoderGraph and the
+    stacked (L, B, nhead, Sy, E // nhead) self-attention keys and values of earlier tokens, and returns the (B, C)
+    logits of the next token and the self-attention keys and values with those of the newest token appended.
+    Only holds the modules that decode_step uses, so that the graph leaves out the encoder's weights.
+    """
+
+    def __init__(self, model: ResnetTransformer) -> None:
+        super().__init__()
+        self.dim = model.dim
+        self.embedding = model.embedding
+        self.dec_pos_encoder = model.dec_pos_encoder
+        self.transformer_decoder = model.transformer_decoder
+        self.fc = model.fc
+
+    def forward(
+        self,
+        y: torch.Tensor,
+        position: torch.Tensor,
+        memory_k: torch.Tensor,
+        memory_v: torch.Tensor,
+        self_k: torch.Tensor,
+        self_v: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        cache = [layer_cache + (None,) for layer_cache in zip(memory_k, memory_v, self_k, self_v)]
+        output, cache = ResnetTransformer.decode_step(self, y, position, cache)
+        _memory_k, _memory_v, new_self_k, new_self_v, _memory_mask = zip(*cache)
+        return output, torch.stack(new_self_k), torch.stack(new_self_v)
+
+
+def export(model: ResnetTransformer, dirname: Path, export_format: str = EXPORT_FORMAT) -> None:
+    """Write the encoder and decoder step graphs of model, and the config ParagraphTextRecognizer reads, to dirname.
+
+    The graphs are traced, so the encoder is specialized to the model's input dims, which exported images must have.
+    """
+    model = model.cpu().eval()
+    dirname.mkdir(parents=True, exist_ok=True)
+    encoder, decoder_step = EncoderGraph(model).eval(), DecoderStepGraph(model).eval()
+    x = torch.rand(1, *model.input_dims)
+    with torch.no_grad():
+        memory_k, memory_v = encoder(x)
+    L, B, nhead, _Sx, head_dim = memory_k.shape
+    cache = torch.zeros(L, B, nhead, 1, head_dim)  # traced with one earlier token, so the length stays dynamic
+    step_inputs = (torch.tensor([model.start_token]), torch.tensor(1), memory_k, memory_v, cache, cache)
+    filenames = FILENAMES[export_format]
+
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=torch.jit.TracerWarning)
+        if export_format == "torchscript":
+            torch.jit.trace(encoder, (x,)).save(str(dirname / filenames["encoder"]))
+            torch.jit.trace(decoder_step, step_inputs).save(str(dirname / filenames["decoder_step"]))
+        else:
+            kv_axes = {1: "batch", 3: "length"}
+            torch.onnx.export(
+                encoder,
+                (x,),
+                str(dirname / filenames["encoder"]),
+                input_names=["x"],
+                output_names=["memory_k", "memory_v"],
+                dynamic_axes={"x": {0: "batch"}, "memory_k": {1: "batch"}, "memory_v": {1: "batch"}},
+                opset_version=ONNX_OPSET,
+                dynamo=False,
+            )
+            torch.onnx.export(
+                decoder_step,
+                step_inputs,
+                str(dirname / filenames["decoder_step"]),
+                input_names=["y", "position", "memory_k", "memory_v", "self_k", "self_v"],
+                output_names=["logits", "new_self_k", "new_self_v"],
+                dynamic_axes={
+                    "y": {0: "batch"},
+                    "memory_k": {1: "batch"},
+                    "memory_v": {1: "batch"},
+                    "self_k": kv_axes,
+                    "self_v": kv_axes,
+                    "logits": {0: "batch"},
+                    "new_self_k": kv_axes,
+                    "new_self_v": kv_axes,
+                },
+                opset_version=ONNX_OPSET,
+                dynamo=False,
+            )
+
+    config = {
+        "format": export_format,
+        **filenames,
+        "mapping": list(model.mapping),
+        "start_token": model.start_token,
+        "end_token": model.end_token,
+        "padding_token": model.padding_token,
+        "max_output_length": model.max_output_length,
+        "input_dims": list(model.input_dims),
+    }
+    with open(dirname / CONFIG_FILENAME, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+
+
+def verify(model: ResnetTransformer, dirname: Path, dataset, num_pages: int) -> dict:
+    """Compare the greedy tokens of the exported graphs with those of the eager model on pages of dataset."""
+    start = time.perf_counter()
+    recognizer = ParagraphTextRecognizer(dirname)
+    results = {"load_seconds": time.perf_counter() - start, "pages": 0, "matches": 0}
+    eager_seconds, exported_seconds = 0.0, 0.0
+    for ind in range(min(num_pages, len(dataset))):
+        x = dataset[ind][0][None]  # (1, 1, H, W)
+        start = time.perf_counter()
+        with torch.no_grad():
+            expected = model(x).numpy()
+        eager_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        tokens = recognizer.greedy_decode(x.numpy())
+        exported_seconds += time.perf_counter() - start
+        results["pages"] += 1
+        results["matches"] += int((tokens == expected).all())
+    results["eager_seconds_per_page"] = eager_seconds / max(results["pages"], 1)
+    results["exported_seconds_per_page"] = exported_seconds / max(results["pages"], 1)
+    return results
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--load_checkpoint", type=str, default=None, help="TransformerLitModel checkpoint to export."
+    )
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory to write the graphs and config to.")
+    parser.add_argument(
+        "--export_format", type=str, default=EXPORT_FORMAT, choices=list(FILENAMES), help="Format of the graphs."
+    )
+    parser.add_argument(
+        "--verify_pages",
+        type=int,
+        default=VERIFY_PAGES,
+        help=f"Number of test pages to compare with the eager model token for token. Default is {VERIFY_PAGES}.",
+    )
+
+    data_group = parser.add_argument_group("Data Args")
+    BIAMParagraphs.add_to_argparse(data_group)
+    model_group = parser.add_argument_group("Model Args")
+    ResnetTransformer.add_to_argparse(model_group)
+    lit_model_group = parser.add_argument_group("LitModel Args")
+    lit_models.TransformerLitModel.add_to_argparse(lit_model_group)
+
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def main():
+    """
+    Export a checkpoint for paragraph_text_recognizer.py and verify it against the eager model.
+
+    Sample command:
+    ```
+    python training/export_model.py --load_checkpoint=training/logs/model.ckpt --output_dir=artifacts/recognizer
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+    if str(args.keep_aspect_ratio).lower() == "true":
+        raise ValueError("The exported encoder takes images resized to the input dims, so it cannot keep aspect ratios")
+
+    data = BIAMParagraphs(args)
+    model = ResnetTransformer(data_config=data.config(), args=args)
+    if args.load_checkpoint is not None:
+        lit_model = lit_models.TransformerLitModel.load_from_checkpoint(args.load_checkpoint, args=args, model=model)
+        model = lit_model.model
+    model = model.cpu().eval()
+
+    export(model, Path(args.output_dir), args.export_format)
+    if args.verify_pages > 0:
+        data.setup("test")
+        results = verify(model, Path(args.output_dir), data.data_test, args.verify_pages)
+        print(
+            f"{results['matches']}/{results['pages']} pages match the eager model token for token; "
+            f"seconds/page eager={results['eager_seconds_per_page']:.3f} "
+            f"exported={results['exported_seconds_per_page']:.3f}; load seconds={results['load_seconds']:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
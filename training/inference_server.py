@@ -0,0 +1,311 @@
+"""Local HTTP server that recognizes paragraph images, batching concurrent requests together."""
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import multiprocessing
+import queue
+import socketserver
+import threading
+import time
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.data_util import pad_images
+import lit_models
+import metadata.b_iam_paragraphs as metadata
+from models.resnet_transformer import ResnetTransformer
+from stems.paragraph import ParagraphStem
+
+HOST = "127.0.0.1"
+PORT = 8000
+MAX_BATCH_SIZE = 8
+MAX_LATENCY_MS = 50.0
+PREPROCESSING_WORKERS = 2
+LATENCY_WINDOW = 1000  # number of recent requests that latency percentiles are computed over
+DEFAULT_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class MicroBatcher:
+    """Coalesce preprocessed images submitted from many threads into batches, and recognize them together.
+
+    A batch is closed when it has max_batch_size images, or max_latency seconds after its first image was
+    submitted, so batching adds at most max_latency to the latency of a request.
+    """
+
+    def __init__(self, lit_model: lit_models.TransformerLitModel, max_batch_size: int, max_latency: float) -> None:
+        self.lit_model = lit_model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.metrics = ServerMetrics()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, image: torch.Tensor) -> Future:
+        """Queue a (1, H, W) preprocessed image, returning a future of its text."""
+        future = Future()
+        self.queue.put((time.perf_counter(), image, future))
+        return future
+
+    def _next_batch(self) -> List[Tuple[float, torch.Tensor, Future]]:
+        batch = [self.queue.get()]
+        deadline = batch[0][0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                timeout = deadline - time.perf_counter()
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            submitted, images, futures = zip(*batch)
+            try:
+                texts = self.recognize(images)
+            except Exception as error:  # pylint: disable=broad-except
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            self.metrics.record_batch(
+                len(batch), queue_seconds=sum(start - t for t in submitted), inference=time.perf_counter() - start
+            )
+            for future, text in zip(futures, texts):
+                future.set_result(text)
+
+    def recognize(self, images: List[torch.Tensor]) -> List[str]:
+        """Return the texts of preprocessed images, padding them to a common size if they differ."""
+        device = self.lit_model.device
+        with torch.inference_mode():
+            if all(image.shape == images[0].shape for image in images):
+                preds = self.lit_model(torch.stack(images).to(device))
+            else:
+                x, image_sizes = pad_images(images)
+                preds = self.lit_model(x.to(device), image_sizes.to(device))
+        return self.lit_model.batchmap(preds)
+
+
+class ServerMetrics:
+    """Thread-safe counters of requests and batches, and recent request latencies."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.requests = self.errors = self.batches = 0
+        self.queue_seconds = self.inference_seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record_batch(self, size: int, queue_seconds: float, inference: float) -> None:
+        with self._lock:
+            self.batches += 1
+            self.queue_seconds += queue_seconds
+            self.inference_seconds += inference * size
+
+    def record_request(self, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latencies.append(seconds)
+
+    def snapshot(self, queue_depth: int) -> dict:
+        """Return the counters, throughput, mean batch size and latency percentiles of recent requests."""
+        with self._lock:
+            served = self.requests - self.errors
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": served / max(self.batches, 1),
+                "throughput_rps": served / (time.perf_counter() - self.started),
+                "latency_p50_seconds": float(np.percentile(latencies, 50)),
+                "latency_p99_seconds": float(np.percentile(latencies, 99)),
+                "mean_queue_seconds": self.queue_seconds / max(served, 1),
+                "mean_inference_seconds": self.inference_seconds / max(served, 1),
+                "queue_depth": queue_depth,
+            }
+
+
+_worker_stem = None  # ParagraphStem of the current preprocessing process
+_worker_invert = False
+
+
+def _init_preprocessing_worker(keep_aspect_ratio: bool, invert: bool) -> None:
+    global _worker_stem, _worker_invert
+    torch.set_num_threads(1)
+    _worker_stem = ParagraphStem(keep_aspect_ratio=keep_aspect_ratio)
+    _worker_invert = invert
+
+
+def _preprocess(data: bytes) -> np.ndarray:
+    """Decode an image file and run it through the non-augmenting ParagraphStem, returning (1, H, W) pixels."""
+    image = Image.open(io.BytesIO(data)).convert("L")
+    if _worker_invert:
+        image = ImageOps.invert(image)
+    return _worker_stem(image).numpy()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """POST /predict with an image file as the body returns its text; GET /metrics and GET /health."""
+
+    protocol_version = "HTTP/1.1"  # keep connections alive between requests
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._respond(404, {"error": f"Unknown path {self.path}"})
+            return
+        start = time.perf_counter()
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            pixels = self.server.pool.submit(_preprocess, data).result()
+            text = self.server.batcher.submit(torch.from_numpy(pixels)).result()
+        except Exception as error:  # pylint: disable=broad-except
+            self.server.batcher.metrics.record_request(time.perf_counter() - start, error=True)
+            self._respond(400, {"error": repr(error)})
+            return
+        seconds = time.perf_counter() - start
+        self.server.batcher.metrics.record_request(seconds)
+        self._respond(200, {"text": text, "seconds": seconds})
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            batcher = self.server.batcher
+            self._respond(200, batcher.metrics.snapshot(queue_depth=batcher.queue.qsize()))
+        elif self.path == "/health":
+            self._respond(200, {"status": "ok"})
+        else:
+            self._respond(404, {"error": f"Unknown path {self.path}"})
+
+    def _respond(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass  # requests are counted in /metrics instead
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--load_checkpoint", type=str, default=None, help="TransformerLitModel checkpoint to serve."
+    )
+    parser.add_argument("--host", type=str, default=HOST, help=f"Address to listen on. Default is {HOST}.")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Port to listen on. Default is {PORT}.")
+    parser.add_argument(
+        "--unix_socket", type=str, default=None, help="If passed, listen on this Unix socket instead of host:port."
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=MAX_BATCH_SIZE,
+        help=f"Most requests recognized together. Default is {MAX_BATCH_SIZE}.",
+    )
+    parser.add_argument(
+        "--max_latency_ms",
+        type=float,
+        default=MAX_LATENCY_MS,
+        help=f"Longest a request waits for others to batch with. Default is {MAX_LATENCY_MS}.",
+    )
+    parser.add_argument(
+        "--preprocessing_workers",
+        type=int,
+        default=PREPROCESSING_WORKERS,
+        help=f"Processes decoding and resizing images. Default is {PREPROCESSING_WORKERS}.",
+    )
+    parser.add_argument(
+        "--keep_aspect_ratio",
+        type=str,
+        default="false",
+        help="Resize images within the input dims with their own aspect ratio, as the model was trained with.",
+    )
+    parser.add_argument(
+        "--invert", type=str, default="false", help="Whether images have dark text on a light background."
+    )
+    parser.add_argument("--device", type=str, default=DEFAULT_DEVICE, help="Device to run the model on.")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads, if set.")
+
+    model_group = parser.add_argument_group("Model Args")
+    ResnetTransformer.add_to_argparse(model_group)
+    lit_model_group = parser.add_argument_group("LitModel Args")
+    lit_models.TransformerLitModel.add_to_argparse(lit_model_group)
+
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def main():
+    """
+    Load a checkpoint once and serve paragraph recognition until interrupted.
+
+    Sample command:
+    ```
+    python training/inference_server.py --load_checkpoint=training/logs/model.ckpt --max_batch_size=8
+    curl --data-binary @page.png http://127.0.0.1:8000/predict
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    # spawned rather than forked, so preprocessing processes neither copy the model nor inherit torch's threads
+    pool = ProcessPoolExecutor(
+        args.preprocessing_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_preprocessing_worker,
+        initargs=(args.keep_aspect_ratio.lower() == "true", args.invert.lower() == "true"),
+    )
+
+    data_config = {"input_dims": metadata.DIMS, "output_dims": metadata.OUTPUT_DIMS, "mapping": metadata.MAPPING}
+    model = ResnetTransformer(data_config=data_config, args=args)
+    if args.load_checkpoint is not None:
+        lit_model = lit_models.TransformerLitModel.load_from_checkpoint(args.load_checkpoint, args=args, model=model)
+    else:
+        lit_model = lit_models.TransformerLitModel(args=args, model=model)
+    lit_model = lit_model.to(args.device).eval()
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+        server = _ThreadingUnixHTTPServer(args.unix_socket, _Handler)
+        address = args.unix_socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), _Handler)
+        address = f"http://{args.host}:{args.port}"
+    server.pool = pool
+    server.batcher = MicroBatcher(lit_model, args.max_batch_size, args.max_latency_ms / 1000)
+    print(f"Serving on {address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Quantize a trained ResnetTransformer to int8 for CPU inference, and report its size, latency and CER against fp32."""
+import argparse
+import itertools
+import json
+from pathlib import Path
+
+import torch
+
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(PARENT_DIR)
+
+from data.B_iam_paragraphs import BIAMParagraphs
+import lit_models
+from models.quantization import DEFAULT_BACKEND, quantize_model, save_quantized_model, serialized_size
+from models.resnet_transformer import ResnetTransformer
+from training.evaluate_decoding import evaluate
+
+CALIBRATION_BATCHES = 8
+
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--load_checkpoint", type=str, default=None, help="TransformerLitModel checkpoint to quantize."
+    )
+    parser.add_argument(
+        "--calibration_batches",
+        type=int,
+        default=CALIBRATION_BATCHES,
+        help=f"Number of val batches to observe encoder activation ranges on. Default is {CALIBRATION_BATCHES}.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default=DEFAULT_BACKEND,
+        choices=torch.backends.quantized.supported_engines,
+        help="Quantized kernels to target: 'x86' or 'fbgemm' for x86 servers, 'qnnpack' for ARM.",
+    )
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads, if set.")
+    parser.add_argument("--output", type=str, default=None, help="If passed, save the quantized model here.")
+    parser.add_argument("--report", type=str, default=None, help="If passed, write the comparison as JSON.")
+
+    data_group = parser.add_argument_group("Data Args")
+    BIAMParagraphs.add_to_argparse(data_group)
+    model_group = parser.add_argument_group("Model Args")
+    ResnetTransformer.add_to_argparse(model_group)
+    lit_model_group = parser.add_argument_group("LitModel Args")
+    lit_models.TransformerLitModel.add_to_argparse(lit_model_group)
+
+    parser.add_argument("--help", "-h", action="help")
+    return parser
+
+
+def main():
+    """
+    Quantize a checkpoint, calibrating on val pages, then compare it with fp32 on the test split.
+
+    Sample command:
+    ```
+    python training/quantize_model.py --load_checkpoint=training/logs/model.ckpt --output=model_int8.pt --num_workers=0
+    ```
+    """
+    parser = _setup_parser()
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    data = BIAMParagraphs(args)
+    data.setup()
+    model = ResnetTransformer(data_config=data.config(), args=args)
+    if args.load_checkpoint is not None:
+        lit_model = lit_models.TransformerLitModel.load_from_checkpoint(args.load_checkpoint, args=args, model=model)
+    else:
+        lit_model = lit_models.TransformerLitModel(args=args, model=model)
+    lit_model = lit_model.cpu().eval()
+
+    calibration_images = (batch[0] for batch in itertools.islice(data.val_dataloader(), args.calibration_batches))
+    quantized_model = quantize_model(lit_model.model, calibration_images, backend=args.backend)
+    if args.output is not None:
+        save_quantized_model(quantized_model, args.output, backend=args.backend)
+    quantized_lit_model = lit_models.TransformerLitModel(args=args, model=quantized_model).eval()
+
+    results = {}
+    for name, candidate in [("fp32", lit_model), ("int8", quantized_lit_model)]:
+        results[name] = evaluate(candidate, data.test_dataloader())
+        results[name]["size_mb"] = serialized_size(candidate.model) / 1024 ** 2
+    results["delta"] = {key: results["int8"][key] - results["fp32"][key] for key in results["fp32"]}
+
+    print(f"{'':>6} {'cer':>8} {'seconds/image':>14} {'size (MB)':>10}")
+    for name, result in results.items():
+        print(f"{name:>6} {result['cer']:>8.4f} {result['seconds_per_image']:>14.3f} {result['size_mb']:>10.1f}")
+
+    if args.report is not None:
+        with open(Path(args.report), "w") as f:
+            json.dump({"backend": args.backend, "beam_width": args.beam_width, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,13 @@ PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(PARENT_DIR)
 
 import lit_models
-from training.training_util import DATA_CLASS_MODULE, import_class, MODEL_CLASS_MODULE, setup_data_and_model_from_args
+from training.training_util import (
+    DATA_CLASS_MODULE,
+    import_class,
+    LoaderStallMonitor,
+    MODEL_CLASS_MODULE,
+    setup_data_and_model_from_args,
+)
 
 
 # In order to ensure reproducible experiments, we must set random seeds.
@@ -36,7 +42,7 @@ def _setup_parser():
     parser.add_argument(
         "--data_class",
         type=str,
-        default="BanglaMNIST",
+        default="BanglaEMNIST",
         help=f"String identifier for the data class, relative to {DATA_CLASS_MODULE}.",
     )
     parser.add_argument(
@@ -68,7 +74,7 @@ def _setup_parser():
     model_class.add_to_argparse(model_group)
 
     lit_model_group = parser.add_argument_group("LitModel Args")
-    lit_models.BaseLitModel.add_to_argparse(lit_model_group)
+    lit_models.TransformerLitModel.add_to_argparse(lit_model_group)
 
     parser.add_argument("--help", "-h", action="help")
     return parser
@@ -86,7 +92,7 @@ def main():
 
     Sample command:
     ```
-    python training/run_experiment.py --max_epochs=3 --gpus='0,' --num_workers=20 --model_class=MLP --data_class=MNIST
+    python training/run_experiment.py --max_epochs=3 --gpus='0,' --num_workers=20 --model_class=MLP --data_class=BanglaEMNIST
     ```
 
     For basic help documentation, run the command
@@ -99,7 +105,7 @@ def main():
     To see which command line args are available and read their documentation, provide values for those arguments
     before invoking --help, like so:
     ```
-    python training/run_experiment.py --model_class=MLP --data_class=MNIST --help
+    python training/run_experiment.py --model_class=MLP --data_class=BanglaEMNIST --help
     """
     parser = _setup_parser()
     args = parser.parse_args()
@@ -136,7 +142,7 @@ def main():
 
     summary_callback = pl.callbacks.ModelSummary(max_depth=2)
 
-    callbacks = [summary_callback, checkpoint_callback]
+    callbacks = [summary_callback, checkpoint_callback, LoaderStallMonitor()]
     if args.stop_early:
         early_stopping_callback = pl.callbacks.EarlyStopping(
             monitor="validation/loss", mode="min", patience=args.stop_early
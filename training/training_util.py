@@ -1,6 +1,9 @@
 """Utilities for model development scripts: training and staging."""
 import argparse
 import importlib
+import time
+
+import pytorch_lightning as pl
 
 import os
 import sys
@@ -35,4 +38,76 @@ def setup_data_and_model_from_args(args: argparse.Namespace):
     data = data_class(args)
     model = model_class(data_config=data.config(), args=args)
 
-    return data, model
\ No newline at end of file
+    return data, model
+
+
+class LoaderStallMonitor(pl.Callback):
+    """Log how long training and validation wait for batches from their DataLoaders, once per epoch.
+
+    The wait of a batch is the time between the end of the previous step, or the start of the epoch, and the
+    start of the step, so it covers fetching the batch from the workers and transferring it to the device.
+    Logs <stage>/loader_wait_seconds, the total wait of the epoch, <stage>/loader_wait_fraction, its share of the
+    epoch's time, and <stage>/first_batch_wait_seconds, which includes starting the workers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._clocks = {}
+
+    def _start(self, stage: str) -> None:
+        now = time.perf_counter()
+        self._clocks[stage] = {"start": now, "last": now, "wait": 0.0, "first": None}
+
+    def _batch_start(self, stage: str) -> None:
+        clock = self._clocks[stage]
+        wait = time.perf_counter() - clock["last"]
+        clock["wait"] += wait
+        if clock["first"] is None:
+            clock["first"] = wait
+
+    def _batch_end(self, stage: str) -> None:
+        self._clocks[stage]["last"] = time.perf_counter()
+
+    def _log(self, stage: str, pl_module: pl.LightningModule) -> None:
+        clock = self._clocks.pop(stage, None)
+        if clock is None or clock["first"] is None:
+            return
+        elapsed = max(clock["last"] - clock["start"], 1e-9)
+        pl_module.log(f"{stage}/loader_wait_seconds", clock["wait"], on_epoch=True)
+        pl_module.log(f"{stage}/loader_wait_fraction", clock["wait"] / elapsed, on_epoch=True)
+        pl_module.log(f"{stage}/first_batch_wait_seconds", clock["first"], on_epoch=True)
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._start("train")
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self._batch_start("train")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self._batch_end("train")
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self._log("train", pl_module)
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        if "train" in self._clocks:
+            self._clocks["train"]["paused"] = time.perf_counter()
+        if not trainer.sanity_checking:
+            self._start("validation")
+
+    def on_validation_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        if "validation" in self._clocks:
+            self._batch_start("validation")
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        if "validation" in self._clocks:
+            self._batch_end("validation")
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        self._log("validation", pl_module)
+        clock = self._clocks.get("train")
+        if clock is not None and "paused" in clock:
+            # validation within a training epoch is neither training time nor time spent waiting for its batches
+            now = time.perf_counter()
+            clock["start"] += now - clock.pop("paused")
+            clock["last"] = now
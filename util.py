@@ -1,6 +1,7 @@
 """Utility functions"""
 import os
 import contextlib
+import hashlib
 from pathlib import Path
 from typing import Union
 
@@ -29,6 +30,12 @@ def read_image_pil_file(image_file, grayscale=False) -> Image:
             image = image.convert(mode=image.mode)
         return image
     
+def compute_sha256(filename: Union[Path, str]):
+    """Return SHA256 checksum of a file."""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
 @contextlib.contextmanager
 def temporary_working_directory(working_dir: Union[str, Path]):
     """Temporarily switches to a directory, then returns to the original directory on exit."""